@@ -13,9 +13,11 @@
 # You should have received a copy of the Reciprocal Public License along with
 # Cutedots. If not, see <http://opensource.org/licenses/rpl-1.5>.
 
+import os
 from PyQt5 import QtCore, QtWidgets
 from PyQt5.QtWebEngineWidgets import QWebEngineView
 import preprocess
+import trajectorization
 import transform
 import analysis
 from plotdialog import DataPlot
@@ -48,6 +50,16 @@ class CuteDotsActions(QtCore.QObject):
     def newDataPlot(self):
         return DataPlot(self.parent())
 
+    @property
+    def tracker(self):
+        "Frame to frame tracking mode chosen in the Import menu"
+        return self.trackerGroup.checkedAction().data()
+
+    @property
+    def workers(self):
+        "Processes used when importing"
+        return os.cpu_count() or 1
+
     def makeMenus(self):
         self.fileMenu()
         self.operationsMenu()
@@ -73,6 +85,17 @@ class CuteDotsActions(QtCore.QObject):
                              self.importCSV)
         importMenu.addAction('&Import CSV file (current Motive)...',
                              self.importCSV2)
+        importMenu.addSeparator()
+        trackerMenu = importMenu.addMenu('Tracking')
+        self.trackerGroup = QtWidgets.QActionGroup(self)
+        for name, label in trajectorization.trackers.items():
+            action = trackerMenu.addAction(label)
+            action.setCheckable(True)
+            action.setChecked(name == 'greedy')
+            action.setData(name)
+            self.trackerGroup.addAction(action)
+        self.streamAction = importMenu.addAction('Low memory import')
+        self.streamAction.setCheckable(True)
 
         exportMenu = menu.addMenu('Export')
         exportMenu.addAction('Save image sequence',
@@ -235,7 +258,8 @@ class CuteDotsActions(QtCore.QObject):
         if fn == '':
             return
         progress = self.parent().mkProgress("Importing...")
-        qtdFn = preprocess.ppC3D(fn, progress)
+        qtdFn = preprocess.ppC3D(fn, progress, self.tracker, self.workers,
+                                 self.streamAction.isChecked())
         self.parent().loadDataFile(qtdFn)
 
     @updateDisplay
@@ -245,7 +269,8 @@ class CuteDotsActions(QtCore.QObject):
         if fn == '':
             return
         progress = self.parent().mkProgress("Importing...")
-        qtdFn = preprocess.ppCSV(fn, progress)
+        qtdFn = preprocess.ppCSV(fn, progress, self.tracker, self.workers,
+                                 self.streamAction.isChecked())
         self.parent().loadDataFile(qtdFn)
 
     @updateDisplay
@@ -255,7 +280,8 @@ class CuteDotsActions(QtCore.QObject):
         if fn == '':
             return
         progress = self.parent().mkProgress("Importing...")
-        qtdFn = preprocess.ppCSV2(fn, progress)
+        qtdFn = preprocess.ppCSV2(fn, progress, self.tracker, self.workers,
+                                  self.streamAction.isChecked())
         self.parent().loadDataFile(qtdFn)
 
     @warnIfNoDataLoaded
@@ -293,7 +319,8 @@ class CuteDotsActions(QtCore.QObject):
             self.parent(), "Match trajectories", "Min. frame gap", 0, -100, 1000)
         if not ok: return
         progress = self.parent().mkProgress("Matching trajectories")
-        modelops.matchTrajectories(self.parent().data, threshold, maxGap, progress)
+        modelops.matchTrajectories(self.parent().data, threshold, maxGap,
+                                   progress, minGap)
 
     @warnIfNoDataLoaded
     @updateDisplay
@@ -309,8 +336,14 @@ class CuteDotsActions(QtCore.QObject):
             self.parent(), "Fill trajectory gaps",
             "Max. gap to fill (secs.)", 0.2, 0.0, 10.0)
         if not ok: return
+        labels = list(modelops.interpolators.values())
+        label, ok = QtWidgets.QInputDialog.getItem(
+            self.parent(), "Fill trajectory gaps", "Interpolation",
+            labels, 0, False)
+        if not ok: return
+        method = list(modelops.interpolators.keys())[labels.index(label)]
         progress = self.parent().mkProgress("Filling small gaps...")
-        modelops.fillGaps(self.parent().data, maxGap, maxGap, progress)
+        modelops.fillGaps(self.parent().data, maxGap, maxGap, progress, method)
         progress.close()
 
     @warnIfNoDataLoaded
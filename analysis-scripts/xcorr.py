@@ -1,5 +1,8 @@
 from __future__ import print_function
-import h5py
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dotsio as dio
 import numpy as np
 import pylab as pl
 import copy
@@ -10,34 +13,29 @@ class MotionData:
         self.data = data
         self.frameRate = frameRate
 
-    def readFromH5(self, fn):
-        with h5py.File(fn, 'r') as f:
-            trajs = f["trajectories"]
-            if not 'frame_rate' in trajs.attrs:
-                print("Warning, no framerate specified in file. Default to 100.")
+    def readFromH5(self, fn, parts=None):
+        "Read trajectories, only those with names starting with parts if given."
+        td = dio.trajDataFromH5(fn, parts=parts)
+        self.frameRate = td.frameRate
+        self.data = {}
+        for traj in td.trajs:
+            if traj.beginFrame != 0:
+                print("Error. Trajectory", traj.name, "begins at frame", traj.beginFrame)
+                return None
+            self.data[traj.name] = traj.pointData
+        trajLen = None
+        for name, traj in self.data.items():
+            if trajLen is None:
+                trajLen = traj.shape[0]
             else:
-                self.frameRate = trajs.attrs['frame_rate']
-            self.data = {}
-            for trName in list(trajs):
-                tr = trajs[trName]
-                bframe = tr.attrs['begin_frame']
-                if bframe != 0:
-                    print("Error. Trajectory", trName, "begins at frame", tr.attrs['begin_frame'])
-                    return None
-                self.data[tr.attrs['name']] = np.array(tr)
-            trajLen = None
-            for name, traj in self.data.items():
-                if trajLen is None:
-                    trajLen = traj.shape[0]
-                else:
-                    if trajLen != traj.shape[0]:
-                        print("Error. Trajectory", trName, "has unequal length.")
+                if trajLen != traj.shape[0]:
+                    print("Error. Trajectory", name, "has unequal length.")
 
     @staticmethod
-    def fromH5(fn):
+    def fromH5(fn, parts=None):
         print(fn)
         md = MotionData()
-        md.readFromH5(fn)
+        md.readFromH5(fn, parts)
         return md
 
     def diff(self):
@@ -270,7 +268,7 @@ class CorrCurves:
             print(name, "mean:", np.mean(x), "\tstd:", np.std(x))
 
 def corrFile(fn, filter, scale, framerate):
-    md = MotionData.fromH5(fn)
+    md = MotionData.fromH5(fn, filter)
     md.frameRate = framerate
     md = md.filterParts(filter)
     cc = CorrCurves.fromMotionData(md, scale, step=framerate/10)
@@ -16,6 +16,7 @@ import numpy as np
 import scipy as sp
 import numpy.ma as ma
 import sys
+from trajdata import trajsToFrameMatrix
 #from numba import jit
 
 def speedFunc(samplerate):
@@ -81,8 +82,7 @@ def energy(trajectories, transform=lambda x: x):
         and t.name[:2] != 'Kn' \
         and t.name[:2] != 'Ft' \
         and t.name[:2] != 'Hn':
-            trajSpeed = np.subtract(100*np.array(t.pointData[1:]),
-                                    100*np.array(t.pointData[:-1]))  # find speed
+            trajSpeed = 100*np.diff(t.pointData, axis=0)  # find speed
             trajEnergy = np.sum(trajSpeed**2,1)
             energy[t.beginFrame:t.endFrame-1] += trajEnergy     # store energy
     return transform(energy)
@@ -108,21 +108,18 @@ def logEnergyPairFromTrajData(td):
 
 def trajsToMaskedPosition(trajs):
     numFrames = max([t.endFrame for t in trajs])
-    position = ma.zeros((len(trajs), numFrames, 3))
-    i = 0
-    for t in data.trajs:
-        position.mask[...] = True
-        position[i, t.beginFrame:t.endFrame, :] = t.pointData
-        position.mask[i, t.beginFrame:t.endFrame, :] = False
-        i+=1
-    return position
+    position, valid = trajsToFrameMatrix(trajs, 0, numFrames)
+    mask = np.repeat(~valid[:,:,np.newaxis], 3, 2)
+    return ma.array(position, mask=mask, copy=False)
 
 
 def averagePos(data):
-    "Returns modulus of average position"
+    """Returns modulus of average position, for frames counted from 0
+    (masked before the first frame with samples)."""
 
-    pos = trajsToMaskedPosition(data)
-    return ma.sum(ma.mean(pos,0)**2, 1)**0.5
+    pos = data.asMaskedArray()
+    avg = ma.sum(ma.mean(pos,0)**2, 1)**0.5
+    return ma.concatenate((ma.masked_all(data.minFrame), avg))
 
 def trajsBySubj(trajectories):
     # classify trajectories by subject
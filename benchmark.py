@@ -0,0 +1,708 @@
+# Copyright 2012 Esteban Hurtado
+#
+# This file is part of Cutedots.
+#
+# Cutedots is distributed under the terms of the Reciprocal Public License 1.5.
+#
+# Cutedots is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the Reciprocal Public License 1.5 for more details.
+#
+# You should have received a copy of the Reciprocal Public License along with
+# Cutedots. If not, see <http://opensource.org/licenses/rpl-1.5>.
+
+"""Performance benchmarks on synthetic data.
+
+Run as: python benchmark.py <name> [options]
+"""
+
+from __future__ import print_function
+import os
+import struct
+import tempfile
+import time
+import numpy as np
+import h5py
+from trajdata import RawFrame, RawData, Traj, TrajData
+import scipy.spatial.distance as spDistance
+import c3dformat
+import dotsio
+import trajectorization as tz
+
+
+def timeit(func, *args, **kargs):
+    "Returns (seconds, result) of calling func once."
+    t0 = time.time()
+    result = func(*args, **kargs)
+    return time.time() - t0, result
+
+
+def synthTrajData(hours=1.0, numMarkers=40, framerate=120.0,
+                  fragmentLength=30.0, seed=0):
+    """Labeled-looking session with markers broken in fragments.
+
+    fragmentLength is the mean fragment length in seconds.
+    """
+    rng = np.random.RandomState(seed)
+    numFrames = int(hours * 3600 * framerate)
+    td = TrajData()
+    td.frameRate = td.framerate = framerate
+    for m in range(numMarkers):
+        name = "%s%s%d" % (['UB', 'LB', 'Kn', 'Ft', 'El', 'Hn'][m % 6],
+                           'LR'[(m // 6) % 2], 1 + (m // 12) % 2)
+        center = rng.uniform(-800, 800, 3)
+        begin = 0
+        while begin < numFrames:
+            n = min(numFrames - begin,
+                    1 + int(rng.exponential(fragmentLength * framerate)))
+            t = Traj(begin, name)
+            t.pointData = center + np.cumsum(rng.normal(0, 1, (n, 3)), 0)
+            td.trajs.append(t)
+            begin += n + rng.randint(0, int(framerate))
+    return td
+
+
+def legacyTrajDataFromH5(filename):
+    "Reference loader building one ndarray per sample."
+    td = TrajData()
+    source = h5py.File(filename, 'r')
+    group = source['trajectories']
+    for dsetName in list(group):
+        dset = group[dsetName]
+        tr = Traj(int(dset.attrs['begin_frame']), str(dset.attrs['name']))
+        tr.pointData = [np.array(p) + np.array([0, 0, 0])
+                        for p in dset[()].tolist()]
+        td.trajs.append(tr)
+    source.close()
+    return td
+
+
+def benchH5Read(args):
+    "Compare the vectorized .qtd reader with the per-sample legacy reader."
+    td = synthTrajData(args.hours, args.markers)
+    samples = sum([t.numFrames for t in td.trajs])
+    fn = os.path.join(tempfile.mkdtemp(), 'bench.qtd')
+    td.filename = fn
+    dotsio.trajDataSaveH5(td)
+    print("%d trajectories, %d samples, %.1f MB on disk" %
+          (td.numTrajs, samples, os.path.getsize(fn) / 1e6))
+    tLegacy, legacy = timeit(legacyTrajDataFromH5, fn)
+    tNew, new = timeit(dotsio.trajDataFromH5, fn)
+    for a, b in zip(legacy.trajs, new.trajs):
+        assert a.name == b.name and a.beginFrame == b.beginFrame
+        assert np.array_equal(a.pointData, b.pointData)
+    print("legacy reader:     %8.2f s" % tLegacy)
+    print("vectorized reader: %8.2f s  (x%.1f)" % (tNew, tLegacy / tNew))
+    os.remove(fn)
+
+
+def writeSynthC3d(filename, minutes=30.0, numPoints=60, framerate=100.0,
+                  dropRate=0.2, seed=0):
+    "Float C3D file with randomly invalidated points."
+    rng = np.random.RandomState(seed)
+    numFrames = int(minutes * 60 * framerate)
+    header = struct.pack('BBhhHHhfhhf270shhhhh72s18sh72s44s', 2, 0x50,
+                         numPoints, 0, 1, min(numFrames, 0xffff), 0, -1.0,
+                         3, 1, framerate, b'', 0, 0, 0, 0, 0, b'', b'', 0,
+                         b'', b'')
+    labels = b''.join([('M%03d' % i).encode() for i in range(numPoints)])
+    params = (struct.pack('BBBB', 0, 0x50, 1, 84) +
+              struct.pack('bb', 5, -1) + b'POINT' + struct.pack('hb', 3, 0) +
+              struct.pack('bb', 6, 1) + b'LABELS' +
+              struct.pack('hbbbb', 0, -1, 2, 4, numPoints) + labels)
+    with open(filename, 'wb') as fout:
+        fout.write(header.ljust(512, b'\0'))
+        fout.write(params.ljust(512, b'\0'))
+        for begin in range(0, numFrames, 10000):
+            n = min(10000, numFrames - begin)
+            block = rng.uniform(-1000, 1000, (n, numPoints, 4))
+            block[:,:,3] = np.where(rng.rand(n, numPoints) < dropRate, -1, 1)
+            fout.write(block.astype('<f4').tobytes())
+    return numFrames
+
+
+def legacyRawDataFromC3D(c3d):
+    "Reference importer masking one frame at a time."
+    data = np.array(c3d.data)
+    return [RawFrame(data[i,:,:]) for i in range(data.shape[0])]
+
+
+class NoProgress:
+    def setValue(self, value):
+        pass
+    def setLabelText(self, text):
+        pass
+    def show(self):
+        pass
+    def wasCanceled(self):
+        return False
+
+
+def benchC3dRead(args):
+    "Compare the memory-mapped C3D importer with per-frame masking."
+    fn = os.path.join(tempfile.mkdtemp(), 'bench.c3d')
+    numFrames = writeSynthC3d(fn, args.hours * 60, args.markers)
+    print("%d frames, %d points, %.1f MB on disk" %
+          (numFrames, args.markers, os.path.getsize(fn) / 1e6))
+    c3d = c3dformat.C3d(fn)
+    tLegacy, legacy = timeit(legacyRawDataFromC3D, c3d)
+    tNew, new = timeit(dotsio.rawDataFromC3D, c3dformat.C3d(fn), NoProgress())
+    assert len(legacy) == new.numFrames == numFrames
+    for a, b in zip(legacy, new):
+        assert np.array_equal(a.data, b.data)
+    print("per-frame importer:  %8.2f s" % tLegacy)
+    print("vectorized importer: %8.2f s  (x%.1f)" % (tNew, tLegacy / tNew))
+    os.remove(fn)
+
+
+def synthRawData(hours=1.0, numMarkers=40, framerate=100.0, dupRate=0.1,
+                 seed=0):
+    "Raw data where some points are duplicated at about one unit away."
+    rng = np.random.RandomState(seed)
+    numFrames = int(hours * 3600 * framerate)
+    counts = rng.binomial(numMarkers, 0.9, numFrames)
+    offsets = np.zeros(numFrames + 1, np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    points = rng.uniform(-1000, 1000, (offsets[-1], 3))
+    local = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+    dup = np.flatnonzero((rng.rand(offsets[-1]) < dupRate) & (local > 0))
+    direction = rng.normal(0, 1, (len(dup), 3))
+    direction /= np.sqrt(np.sum(direction**2, axis=1))[:,np.newaxis]
+    radius = rng.uniform(0, 2, len(dup))[:,np.newaxis]
+    points[dup] = points[dup - 1] + radius * direction
+    rd = RawData(points.astype(np.float32), offsets)
+    rd.frameRate = framerate
+    return rd
+
+
+def legacyJoinClosePoints(frame, maxDist=1):
+    "Reference merging checking every pair of points in one frame."
+    if frame.numPoints == 0:
+        return frame.data
+    uniquePoint = [True] * frame.numPoints
+    sqDistance = spDistance.squareform(spDistance.pdist(frame.data))
+    for i in range(frame.numPoints):
+        for j in range(i+1, frame.numPoints):
+            if sqDistance[i,j] < maxDist:
+                uniquePoint[j] = False
+    return frame.data[np.array(uniquePoint),:]
+
+
+def benchJoinClose(args):
+    """Compare batch close point merging with the per-frame pair loop.
+
+    The reference only runs on the first frames; its time is scaled to
+    the whole recording.
+    """
+    rd = synthRawData(args.hours, args.markers)
+    numRef = min(rd.numFrames, 20000)
+    print("%d frames, %d points" % (rd.numFrames, rd.totalPoints))
+    tLegacy, legacy = timeit(lambda: [legacyJoinClosePoints(rd[i])
+                                      for i in range(numRef)])
+    tLegacy *= float(rd.numFrames) / numRef
+    original = rd.points, rd.offsets
+    print("per-frame loop:  %8.2f s (estimated)" % tLegacy)
+    tNew, _ = timeit(rd.joinClosePoints, NoProgress())
+    for i in range(numRef):
+        assert np.array_equal(rd[i].data, legacy[i])
+    print("batch:           %8.2f s  (x%.1f), %d points dropped" %
+          (tNew, tLegacy / tNew, len(original[0]) - rd.totalPoints))
+
+
+def writeSynthCSV2(filename, minutes=30.0, numMarkers=40, framerate=120.0,
+                   dropRate=0.2, seed=0):
+    "Motive-style CSV export with empty cells for missing markers."
+    rng = np.random.RandomState(seed)
+    numFrames = int(minutes * 60 * framerate)
+    with open(filename, 'w') as fout:
+        fout.write('Format Version,1.21,Export Frame Rate,%f,'
+                   'Total Exported Frames,%d\n' % (framerate, numFrames))
+        fout.write('\n' * 5 + 'Frame,Time' + ',X,Y,Z' * numMarkers + '\n')
+        for begin in range(0, numFrames, 10000):
+            n = min(10000, numFrames - begin)
+            xyz = rng.uniform(-2, 2, (n, numMarkers, 3))
+            for i in range(n):
+                cells = ['%d,%.5f' % (begin + i, (begin + i) / framerate)]
+                for m in range(numMarkers):
+                    if rng.rand() < dropRate:
+                        cells.append(',,')
+                    else:
+                        cells.append('%.6f,%.6f,%.6f' % tuple(xyz[i, m]))
+                fout.write(','.join(cells) + '\n')
+    return numFrames
+
+
+def legacyRawDataFromCSV2(filename):
+    "Reference importer parsing one line at a time."
+    with open(filename) as pointsfile:
+        lines = pointsfile.readlines()[7:]
+    return [dotsio.readFrameFromArray2(line.split(','), i)
+            for i, line in enumerate(lines)]
+
+
+def benchCSVRead(args):
+    "Compare the chunked CSV importer with the line by line parser."
+    fn = os.path.join(tempfile.mkdtemp(), 'bench.csv')
+    numFrames = writeSynthCSV2(fn, args.hours * 60, args.markers)
+    print("%d frames, %.1f MB on disk" % (numFrames, os.path.getsize(fn) / 1e6))
+    tLegacy, legacy = timeit(legacyRawDataFromCSV2, fn)
+    tNew, new = timeit(dotsio.rawDataFromCSV2, fn, NoProgress())
+    assert len(legacy) == new.numFrames == numFrames
+    for a, b in zip(legacy, new):
+        assert np.array_equal(a.data, b.data)
+    print("line parser:     %8.2f s" % tLegacy)
+    print("chunked parser:  %8.2f s  (x%.1f)" % (tNew, tLegacy / tNew))
+    os.remove(fn)
+
+
+def synthMotionBlocks(minutes=10.0, numMarkers=40, framerate=100.0,
+                      dropRate=0.01, noise=0.5, seed=0):
+    """Markers oscillating around body-like clusters, some fast enough to
+    come within tracking distance of their neighbours. Yields positions
+    (frames, markers, 3) and presence (frames, markers) by 10000 frames."""
+    rng = np.random.RandomState(seed)
+    numFrames = int(minutes * 60 * framerate)
+    t = np.arange(numFrames) / framerate
+    clusters = rng.uniform(-500, 500, (numMarkers // 4 + 1, 3))
+    center = clusters[np.arange(numMarkers) // 4] + \
+             rng.normal(0, 20, (numMarkers, 3))
+    amp = rng.uniform(10, 150, (numMarkers, 3))
+    freq = rng.uniform(0.05, 1.0, (numMarkers, 3))
+    phase = rng.uniform(0, 2 * np.pi, (numMarkers, 3))
+    for begin in range(0, numFrames, 10000):
+        tt = t[begin:begin + 10000]
+        pos = center + amp * np.sin(2 * np.pi * freq * tt[:,None,None] + phase)
+        pos += rng.normal(0, noise, pos.shape)
+        present = rng.rand(len(tt), numMarkers) > dropRate
+        yield pos, present
+
+
+def synthMotionRawData(minutes=10.0, numMarkers=40, framerate=100.0,
+                       dropRate=0.01, noise=0.5, seed=0):
+    "Raw data of synthMotionBlocks markers."
+    points, counts = [], []
+    for pos, present in synthMotionBlocks(minutes, numMarkers, framerate,
+                                          dropRate, noise, seed):
+        points.append(pos[present].astype(np.float32))
+        counts.append(present.sum(axis=1))
+    rd = RawData.fromCounts(points, counts)
+    rd.frameRate = framerate
+    return rd
+
+
+def writeSynthMotionC3d(filename, minutes=10.0, numMarkers=40,
+                        framerate=100.0):
+    "Float C3D file of synthMotionBlocks markers, missing ones invalid."
+    header = struct.pack('BBhhHHhfhhf270shhhhh72s18sh72s44s', 2, 0x50,
+                         numMarkers, 0, 1, 0xffff, 0, -1.0,
+                         3, 1, framerate, b'', 0, 0, 0, 0, 0, b'', b'', 0,
+                         b'', b'')
+    labels = b''.join([('M%03d' % i).encode() for i in range(numMarkers)])
+    params = (struct.pack('BBBB', 0, 0x50, 1, 84) +
+              struct.pack('bb', 5, -1) + b'POINT' + struct.pack('hb', 3, 0) +
+              struct.pack('bb', 6, 1) + b'LABELS' +
+              struct.pack('hbbbb', 0, -1, 2, 4, numMarkers) + labels)
+    with open(filename, 'wb') as fout:
+        fout.write(header.ljust(512, b'\0'))
+        fout.write(params.ljust(512, b'\0'))
+        for pos, present in synthMotionBlocks(minutes, numMarkers, framerate):
+            block = np.concatenate((pos, np.where(present, 1., -1.)[:,:,None]),
+                                   axis=2)
+            fout.write(block.astype('<f4').tobytes())
+
+
+def legacyDistanceTraj(rdata, threshold=10):
+    "Reference greedy tracker keeping live trajectories in a list."
+    def findMatches(distances):
+        matches = []
+        for row in range(distances.shape[0]):
+            i, j = np.unravel_index(distances.argmin(), distances.shape)
+            if distances[i,j] > threshold:
+                return matches
+            matches.append((i,j))
+            distances[i,:] = threshold + 1
+            distances[:,j] = threshold + 1
+        return matches
+
+    current = []
+    broken = []
+    for fr in range(rdata.numFrames):
+        if len(current) == 0:
+            current.extend([Traj.newFromPoint(p,fr) for p in rdata[fr].data])
+            continue
+        prev = [t.getFrame(fr-1) for t in current]
+        pres = [p for p in rdata[fr].data]
+        matches = findMatches(spDistance.cdist(prev,pres)) if pres else []
+        matchedPts = set()
+        matchedTjs = set()
+        for prevTj, presPt in matches:
+            current[prevTj].addPoint(pres[presPt])
+            matchedTjs.add(current[prevTj])
+            matchedPts.add(presPt)
+        unmatchedTjs = [t for t in current if not (t in matchedTjs)]
+        current.extend([Traj.newFromPoint(pres[i],fr) for i in
+                        range(len(pres)) if not (i in matchedPts)])
+        for t in unmatchedTjs:
+            current.remove(t)
+        broken.extend(unmatchedTjs)
+    return broken + current
+
+
+def benchTracking(args):
+    "Compare frame to frame trackers on runtime and number of fragments."
+    rd = synthMotionRawData(args.hours * 60, args.markers)
+    print("%d frames, %d points" % (rd.numFrames, rd.totalPoints))
+    seconds, legacy = timeit(legacyDistanceTraj, rd)
+    print("%-10s %8.2f s  %8.0f frames/s  %7d fragments" %
+          ('list-based', seconds, rd.numFrames / seconds, len(legacy)))
+    for tracker in tz.trackers:
+        t = tz.Trajectorizer(rd, tracker=tracker)
+        seconds, _ = timeit(t.distanceTraj)
+        print("%-10s %8.2f s  %8.0f frames/s  %7d fragments" %
+              (tracker, seconds, rd.numFrames / seconds, len(t.trajs)))
+        if tracker == 'greedy':
+            for a, b in zip(legacy, t.trajs):
+                assert a.beginFrame == b.beginFrame
+                assert np.array_equal(a.pointData, b.pointData)
+            assert len(legacy) == len(t.trajs)
+
+
+def legacyMatch(trajs, threshold=10, maxGap=3, minGap=0):
+    "Reference Trajectorizer.match comparing every pair of trajectories."
+    trajs = list(trajs)
+
+    def findAdjacent(metric):
+        return [(metric(a,b), a, b) for a in trajs for b in trajs
+                if (a != b) and (b.beginFrame - a.endFrame == 0)]
+
+    def matchAdjacent(metric):
+        adj = findAdjacent(metric)
+        while len(adj) > 0:
+            adj.sort(key=lambda x: x[0])
+            m, a, b = adj[0]
+            if m > 2*threshold:
+                break
+            adj = [p for p in adj if not ((p[1] == a) or (p[2] == b))]
+            adj = [(p[0], a, p[2]) if p[1] == b else p for p in adj]
+            a.extend(b.pointData)
+            trajs.remove(b)
+
+    for i in range(minGap, maxGap+1):
+        matchAdjacent(tz.metricEuclidean(0))
+        matchAdjacent(tz.metricEuclideanPredict(0))
+    return trajs
+
+
+def benchMatching(args):
+    """Compare matching of broken trajectories with the all-pairs version,
+    running the same gap 0 passes, then time the single pass over gaps
+    0 to 3.
+
+    Fragments come from greedy tracking of synthetic motion; keep
+    --hours small, the reference is quadratic.
+    """
+    import copy
+    rd = synthMotionRawData(args.hours * 60, args.markers)
+    t = tz.Trajectorizer(rd)
+    t.distanceTraj()
+    fragments = t.trajs
+    print("%d frames, %d fragments" % (rd.numFrames, len(fragments)))
+    tLegacy, legacy = timeit(legacyMatch, copy.deepcopy(fragments))
+    print("all pairs:  %8.2f s  %7d trajectories" % (tLegacy, len(legacy)))
+
+    def samePasses():
+        for i in range(4):
+            t.matchAdjacentTrajs(tz.metricEuclidean(0))
+            t.matchAdjacentTrajs(tz.metricEuclideanPredict(0))
+
+    t.trajs = copy.deepcopy(fragments)
+    tNew, _ = timeit(samePasses)
+    print("indexed:    %8.2f s  %7d trajectories  (x%.1f)" %
+          (tNew, len(t.trajs), tLegacy / tNew))
+    assert len(legacy) == len(t.trajs)
+    for a, b in zip(legacy, t.trajs):
+        assert a.beginFrame == b.beginFrame
+        assert np.array_equal(a.pointData, b.pointData)
+    # Gaps 0 to 3 at once, as Trajectorizer.match does
+    t.trajs = copy.deepcopy(fragments)
+    tSingle, _ = timeit(t.match)
+    print("all gaps:   %8.2f s  %7d trajectories" % (tSingle, len(t.trajs)))
+
+
+def benchParallel(args):
+    """Frame to frame tracking in --workers processes against the single
+    process tracker; trajectories must be identical."""
+    rd = synthMotionRawData(args.hours * 60, args.markers)
+    print("%d frames, %d points" % (rd.numFrames, rd.totalPoints))
+    for tracker in ('greedy', 'hungarian'):
+        single = tz.Trajectorizer(rd, tracker=tracker)
+        tSingle, _ = timeit(single.distanceTraj)
+        multi = tz.Trajectorizer(rd, tracker=tracker, workers=args.workers)
+        tMulti, _ = timeit(multi.distanceTraj)
+        print("%-10s %8.2f s  %8.2f s with %d workers  (x%.1f)" %
+              (tracker, tSingle, tMulti, args.workers, tSingle / tMulti))
+        assert len(single.trajs) == len(multi.trajs)
+        for a, b in zip(single.trajs, multi.trajs):
+            assert a.beginFrame == b.beginFrame
+            assert np.array_equal(a.pointData, b.pointData)
+
+
+def benchStreaming(args):
+    """Import a synthetic C3D file reading it whole and streaming it, with
+    peak memory allocated through Python; the files must be identical."""
+    import tracemalloc
+    import preprocess
+    fn = os.path.join(tempfile.mkdtemp(), 'bench.c3d')
+    writeSynthMotionC3d(fn, args.hours * 60, args.markers)
+    contents = []
+    for stream in (False, True):
+        tracemalloc.start()
+        seconds, qtdFn = timeit(preprocess.ppC3D, fn, NoProgress(),
+                                workers=args.workers, stream=stream)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%-10s %8.2f s  %8.1f MB peak" %
+              ('streaming' if stream else 'whole file', seconds, peak / 1e6))
+        with h5py.File(qtdFn, 'r') as f:
+            group = f['trajectories']
+            contents.append([(k, group[k][()]) for k in sorted(group)])
+        os.remove(qtdFn)
+    for (k, a), (l, b) in zip(*contents):
+        assert k == l and np.array_equal(a, b)
+
+
+def legacyAverageSameName(trajs):
+    "Reference averageSameNameTrajectories summing frame by frame."
+    indTrajs = {}
+    for traj in trajs:
+        indTrajs.setdefault(traj.name, []).append(traj)
+    newTrajs = []
+    for name, trajs in indTrajs.items():
+        beginFrame = min([t.beginFrame for t in trajs])
+        endFrame = max([t.endFrame for t in trajs])
+        current = None
+        for i in range(beginFrame, endFrame):
+            sx = sy = sz = 0.0
+            count = 0
+            for x, y, z in [t.getFrame(i) for t in trajs if t.hasFrame(i)]:
+                sx += x
+                sy += y
+                sz += z
+                count += 1
+            if count >= 1:
+                if current is None:
+                    current = Traj(i, name)
+                    newTrajs.append(current)
+                current.addPoint([sx/count, sy/count, sz/count])
+            else:
+                current = None
+    return newTrajs
+
+
+def benchAveraging(args):
+    """Average same-name trajectories of a session where every label is
+    carried by several overlapping markers (synthTrajData has 24 labels),
+    against frame by frame summing."""
+    import modelops
+    td = synthTrajData(args.hours, args.markers * 4, fragmentLength=5.0)
+    print("%d trajectories" % len(td.trajs))
+    tLegacy, legacy = timeit(legacyAverageSameName, td.trajs)
+    print("frame by frame: %8.2f s" % tLegacy)
+    tNew, _ = timeit(modelops.averageSameNameTrajectories, td, None)
+    print("stacked:        %8.2f s  (x%.1f)" % (tNew, tLegacy / tNew))
+    assert len(legacy) == len(td.trajs)
+    for a, b in zip(legacy, td.trajs):
+        assert a.name == b.name and a.beginFrame == b.beginFrame
+        assert np.array_equal(a.pointData, b.pointData)
+
+
+def legacyFillGaps(data, maxGapTime, maxSampleTime):
+    "Reference fillGaps with one polyfit per gap and axis."
+    maxGap = int(data.framerate * maxGapTime)
+    maxSample = int(data.framerate * maxSampleTime)
+    indTrajs = {}
+    for traj in data.trajs:
+        indTrajs.setdefault(traj.name, []).append(traj)
+    deleteList = []
+    for name, trajs in indTrajs.items():
+        trajs = sorted(trajs, key=lambda t: t.beginFrame)
+        t0 = trajs[0]
+        for t in trajs[1:]:
+            gap = t.beginFrame - t0.endFrame
+            if gap == 0:
+                t0.extend(t.pointData)
+                deleteList.append(t)
+            elif gap > 0 and gap <= maxGap:
+                fromPts = t0.pointData[-maxSample:]
+                toPts = t.pointData[:maxSample]
+                trainData = np.concatenate((fromPts, toPts))
+                fromLen, toLen = len(fromPts), len(toPts)
+                time = list(range(fromLen)) + \
+                       list(range(fromLen + gap, fromLen + gap + toLen))
+                gapTime = range(fromLen, fromLen + gap)
+                order = 2 if len(time) > 2 else 1
+                t0.extend(np.column_stack(
+                    [np.polyval(np.polyfit(time, trainData[:,i], order), gapTime)
+                     for i in range(3)]))
+                t0.extend(t.pointData)
+                deleteList.append(t)
+            else:
+                t0 = t
+    for t in deleteList:
+        data.trajs.remove(t)
+
+
+def benchFillGaps(args):
+    """Fill all gaps of a session broken in short fragments (at most 24
+    labels, gaps under a second), against one polyfit per gap and axis."""
+    import modelops
+    numMarkers = min(args.markers, 24)
+    td = synthTrajData(args.hours, numMarkers, fragmentLength=2.0)
+    print("%d trajectories" % len(td.trajs))
+    tLegacy, _ = timeit(legacyFillGaps, td, 1.0, 0.2)
+    print("polyfit per gap: %8.2f s" % tLegacy)
+    for method in modelops.interpolators:
+        new = synthTrajData(args.hours, numMarkers, fragmentLength=2.0)
+        tNew, _ = timeit(modelops.fillGaps, new, 1.0, 0.2, None, method)
+        print("%-15s  %8.2f s  (x%.1f)" % (method + ':', tNew, tLegacy / tNew))
+        assert len(new.trajs) == len(td.trajs) == numMarkers
+        if method == 'quadratic':
+            for a, b in zip(td.trajs, new.trajs):
+                assert a.name == b.name and a.beginFrame == b.beginFrame
+                assert np.allclose(a.pointData, b.pointData, rtol=0, atol=1e-6)
+
+
+def legacySwapSubjects(trajs):
+    "Reference swapSubjects rotating by 90 degrees twice, trajectory by trajectory."
+    for traj in trajs:
+        n = traj.name
+        if n[3] == '1':
+            traj.name = n[:3] + '2'
+        elif n[3] == '2':
+            traj.name = n[:3] + '1'
+    for i in range(2):
+        for traj in trajs:
+            x, y, z = traj.pointData.T
+            traj.pointData = np.column_stack((-y, x, z))
+
+
+def benchTransform(args):
+    """Swap subjects (rename and rotate by 180 degrees) in a session broken
+    in short fragments, against two rotation passes."""
+    import modelops
+    td = synthTrajData(args.hours, args.markers, fragmentLength=5.0)
+    print("%d trajectories" % len(td.trajs))
+    tLegacy, _ = timeit(legacySwapSubjects, td.trajs)
+    print("two passes:  %8.2f s" % tLegacy)
+    new = synthTrajData(args.hours, args.markers, fragmentLength=5.0)
+    tNew, _ = timeit(modelops.swapSubjects, new, None)
+    print("composed:    %8.2f s  (x%.1f)" % (tNew, tLegacy / tNew))
+    for a, b in zip(td.trajs, new.trajs):
+        assert a.name == b.name and np.array_equal(a.pointData, b.pointData)
+
+
+def legacyLpFilterTrajData(trajdata, freq):
+    "Reference LpFilterTrajData running the recursion sample by sample."
+    Fc = float(freq) / float(trajdata.framerate)
+    h = np.exp(-2.0 * np.pi * Fc)
+    for traj in trajdata.trajs:
+        data = np.array(traj.pointData)
+        for i in range(3):
+            s = data[:,i]
+            for stage in range(4):
+                y = [s[0]]
+                for x in s:
+                    y.append((1.0 - h)*x + h*y[-1])
+                s = y[1:]
+            data[:,i] = s
+        traj.pointData = data
+
+
+def benchLowPass(args):
+    """Low pass filter a session broken in fragments, against the sample by
+    sample recursion, and check the zero phase batches against filtering
+    trajectories one by one."""
+    import transform
+    td = synthTrajData(args.hours, args.markers, fragmentLength=60.0)
+    print("%d trajectories" % len(td.trajs))
+    tLegacy, _ = timeit(legacyLpFilterTrajData, td, 10.0)
+    print("sample loop: %8.2f s" % tLegacy)
+    new = synthTrajData(args.hours, args.markers, fragmentLength=60.0)
+    tNew, _ = timeit(transform.LpFilterTrajData, new, 10.0)
+    print("batched SOS: %8.2f s  (x%.1f)" % (tNew, tLegacy / tNew))
+    for a, b in zip(td.trajs, new.trajs):
+        assert np.allclose(a.pointData, b.pointData, rtol=1e-9, atol=1e-9)
+    zp = synthTrajData(args.hours, args.markers, fragmentLength=60.0)
+    tZero, _ = timeit(transform.LpFilterTrajData, zp, 10.0, True)
+    print("zero phase:  %8.2f s" % tZero)
+    ref = synthTrajData(args.hours, args.markers, fragmentLength=60.0)
+    for a, b in zip(ref.trajs, zp.trajs):
+        transform.LpFilterTraj(a, 10.0 / ref.framerate, True)
+        assert np.allclose(a.pointData, b.pointData, rtol=1e-9, atol=1e-9)
+
+
+def legacyEnergyLpFilter(s, framerate):
+    "Reference SegSpeakers.lpFilter."
+    a = np.exp(-1/(2*framerate))
+    b = 1.0 - a
+    y_1 = s[0]
+    out = []
+    for x0 in s:
+        y_1 = a*y_1 + b*x0
+        out.append(y_1)
+    return np.array(out)
+
+
+def benchFilters(args):
+    """Speaker segmentation energy smoothing against the sample loop, and
+    every filter kind run in chunks against filtering the whole signal."""
+    import filters
+    framerate = 120.0
+    rng = np.random.RandomState(0)
+    energy = rng.exponential(1.0, int(args.hours * 3600 * framerate))
+    tLegacy, legacy = timeit(legacyEnergyLpFilter, energy, framerate)
+    print("sample loop: %8.2f s" % tLegacy)
+    tNew, new = timeit(filters.filterSignal, energy, 'lowpass',
+                       1.0 / (4.0 * np.pi), framerate, 1)
+    print("filters:     %8.2f s  (x%.1f)" % (tNew, tLegacy / tNew))
+    assert np.allclose(legacy, new, rtol=1e-9, atol=1e-12)
+    signal = rng.normal(0, 1, (len(energy), args.markers, 3))
+    for kind, cutoff in [('lowpass', 10.0), ('butter', 10.0),
+                         ('bandpass', (0.5, 10.0)), ('movavg', 0.5)]:
+        f = filters.Filter(kind, cutoff, framerate)
+        tWhole, whole = timeit(f.apply, signal)
+        chunks = np.concatenate([f.process(c) for c in
+                                 np.array_split(signal, 100)])
+        print("%-9s %8.2f s, chunked max. difference %g" %
+              (kind + ':', tWhole, np.abs(whole - chunks).max()))
+        assert np.allclose(whole, chunks, rtol=1e-9, atol=1e-9)
+
+
+benchmarks = {
+    'h5read': benchH5Read,
+    'c3dread': benchC3dRead,
+    'joinclose': benchJoinClose,
+    'csvread': benchCSVRead,
+    'tracking': benchTracking,
+    'matching': benchMatching,
+    'parallel': benchParallel,
+    'streaming': benchStreaming,
+    'averaging': benchAveraging,
+    'fillgaps': benchFillGaps,
+    'transform': benchTransform,
+    'lowpass': benchLowPass,
+    'filters': benchFilters,
+}
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('name', choices=sorted(benchmarks.keys()))
+    parser.add_argument('--hours', default=2.0, type=float,
+                        help="Length of synthetic recording (hours)")
+    parser.add_argument('--markers', default=40, type=int,
+                        help="Number of synthetic markers")
+    parser.add_argument('--workers', default=4, type=int,
+                        help="Threads or processes for parallel benchmarks")
+    args = parser.parse_args()
+    benchmarks[args.name](args)
@@ -13,8 +13,8 @@
 
 from __future__ import print_function
 import struct
-from numpy import fromstring, reshape, dtype, float32
 import numpy as np
+import os
 
 def printStruct(s):
     for key, code in s.structList:
@@ -158,6 +158,7 @@ class ParamRecord(BinStruct):
 
 class P3df:
     structLen = 16
+    dtype = np.dtype('<f4')
     def __init__(self, string):
         self.x, self.y, self.z, self.camResids = struct.unpack("ffff", string[:16])
     @property
@@ -167,6 +168,7 @@ class P3df:
 
 class P3di:
     structLen = 8
+    dtype = np.dtype('<i2')
     def __init__(self, string):
         self.x, self.y, self.z, self.camResids = struct.unpack("hhhh", string[:8])
     @property
@@ -181,10 +183,10 @@ class P3dFrame:
 
 class C3d:
     def __init__(self, filename):
-        fin = open(filename, 'rb')
         self.filename = filename
         self.data = None
-        self.read(fin)
+        with open(filename, 'rb') as fin:
+            self.read(fin)
     @property
     def numFrames(self):
         if self.data is None:
@@ -242,16 +244,45 @@ class C3d:
         text = labelsParam.data
         for i in range(self.header.numPoints):
             self.pointLabels.append(text.decode()[i*labelLen:(i+1)*labelLen].strip(" "))
-        # Read data section
-        numFrames = self.header.numFrames
+        # Map data section. A negative scale factor means float storage,
+        # otherwise coordinates are integers to be multiplied by it.
+        if self.header.scaleFactor < 0:
+            self.pointClass = P3df
+            self.scale = 1.0
+        else:
+            self.pointClass = P3di
+            self.scale = self.header.scaleFactor
+        self.data = self.mapData(fin.name)
+    def mapData(self, filename):
+        "Point data as a read-only (frames, points, 4) array over the file"
         numPoints = self.header.numPoints
-        totalNumbers = numFrames * numPoints * 4
-        fin.seek(512 * (self.header.dataStart - 1))
-        data = fin.read(totalNumbers * 4)
-        numberData = fromstring(data, dtype(float32))
-        numFrames = len(numberData) / (numPoints*4)
-        numberData = numberData[:(numFrames*numPoints*4)]
-        self.data = reshape(numberData, (numFrames,numPoints,4))
+        itemType = self.pointClass.dtype
+        # Each frame holds its points followed by its analog samples
+        frameType = np.dtype([('points', itemType, (numPoints, 4)),
+                              ('analog', itemType, (self.header.numMeasurements,))])
+        start = 512 * (self.header.dataStart - 1)
+        available = max(0, os.path.getsize(filename) - start) // frameType.itemsize
+        numFrames = self.header.numFrames
+        # Long captures saturate the 16 bit frame counter in the header
+        if numFrames <= 0 or self.header.lastFrameNum == 0xffff:
+            numFrames = available
+        numFrames = min(numFrames, available)
+        if numFrames == 0 or numPoints == 0:
+            return np.zeros((0, numPoints, 4), itemType)
+        frames = np.memmap(filename, frameType, 'r', start, (numFrames,))
+        return frames['points']
+    def validPoints(self, begin=0, end=None):
+        """Coordinates of valid points in frames begin to end (all frames
+        by default), as a flat (N, 3) float32 array, and offsets
+        delimiting each frame."""
+        data = self.data[begin:end]
+        valid = np.asarray(data[:,:,3] >= 0)
+        offsets = np.zeros(len(data) + 1, np.int64)
+        np.cumsum(np.count_nonzero(valid, axis=1), out=offsets[1:])
+        points = data[valid][:,:3].astype(np.float32)
+        if self.scale != 1.0:
+            points *= self.scale
+        return points, offsets
     def printParams(self):
         for key,value in self.paramDict.iteritems():
             print(key.ljust(20), "=", value)
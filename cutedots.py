@@ -15,6 +15,7 @@
 
 
 import traceback
+import multiprocessing
 import errors
 from PyQt5 import QtWidgets
 from mainwindow import CuteDotsMainWindow
@@ -45,4 +46,8 @@ def main():
 
 #from OpenGL.GLUT import glutInit
 
-main()
+# Worker processes (see trajectorization.Trajectorizer.parallelTraj) import
+# this module too where processes are spawned instead of forked
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
@@ -63,22 +63,21 @@ class DotsDisplay:
     def drawElements(self, frame):
         "Draw all markers."
         self.model.trajMap = {}
-        for traj in self.model.data.trajs:
-            if traj.hasFrame(frame):
-                glPushMatrix()
-                px, py, pz = traj.getFrame(frame)
-                self.model.map(traj.name, px, py, pz)
-                glTranslatef(px,py,pz)
-                self.drawElement(traj)
-                glPopMatrix()
+        for traj in self.model.data.trajsAt(frame):
+            glPushMatrix()
+            px, py, pz = traj.getFrame(frame)
+            self.model.map(traj.name, px, py, pz)
+            glTranslatef(px,py,pz)
+            self.drawElement(traj)
+            glPopMatrix()
 
     def drawHeads(self, frame):
         "Draw heads."
+        present = self.model.data.trajsAt(frame)
         for subj in ['1', '2']:
-            trajs = [t for t in self.model.data.trajs 
+            trajs = [t for t in present
                      if t.name[:2] == 'Hd'
-                     and t.name[3] == subj
-                     and t.hasFrame(frame)]
+                     and t.name[3] == subj]
             if len(trajs) >= 3:
                 p1 = trajs[0].getFrame(frame)
                 p2 = trajs[1].getFrame(frame)
@@ -210,7 +209,7 @@ class DotsDisplay:
             raise OpenFileEx(datafilename, 'File not found.')
         # Load
         progress.setLabelText("Loading motion data")
-        data = dotsio.trajDataFromH5(datafilename, progress)
+        data = dotsio.trajDataFromH5(datafilename, progress, lazy=True)
         self.model = modelstate.ModelState(data)
         modelops.sortTrajs(self.model.data)
 
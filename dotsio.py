@@ -11,13 +11,20 @@
 # You should have received a copy of the Reciprocal Public License along with
 # Cutedots. If not, see <http://opensource.org/licenses/rpl-1.5>.
 
-from trajdata import RawFrame, RawData, Traj, TrajData
+from trajdata import RawFrame, RawData, RawDataReadError, Traj, LazyTraj, TrajData
+from collections import OrderedDict
 import h5py
 import numpy as np
 import traceback
 import trajectorization as tz
 import modelops as mops
 import sys
+import os
+import shutil
+import tempfile
+import itertools
+import re
+import io
 
 # C3D
 #####
@@ -25,59 +32,134 @@ import sys
 def rawDataFromC3D(c3d, progress):
     numFrames = c3d.numFrames
     print("Num. frames: %d" % numFrames)
-    rd = RawData()
+    progress.setValue(0)
+    try:
+        points, offsets = c3d.validPoints()
+    except:
+        e = sys.exc_info()[1]
+        print('Error reading frames')
+        print(str(e))
+        traceback.print_exc()
+        points, offsets = np.zeros((0, 3), np.float32), np.zeros(1, np.int64)
+    if progress.wasCanceled():
+        return
+    progress.setValue(50)
+    rd = RawData.fromRagged(points, offsets)
     rd.filename = c3d.filename
     rd.frameRate = c3d.header.frameRate
-
-    for i in range(numFrames):
-        if i % 1000 == 0:
-            progress.setValue( int(100.0*i / numFrames) )
-            if progress.wasCanceled():
-                return
-        try:
-            rd.frames.append( RawFrame(c3d.data[i,:,:]) )
-        except:
-            e = sys.exc_info()[1]
-            print('Error appending frame %d of %d' % (i, numFrames))
-            print(str(e))
-            traceback.print_exc()
-            break
     progress.setValue(100)
     return rd
 
+def rawChunksFromC3D(c3d, progress, chunkFrames=10000):
+    """Raw data of a C3D file in consecutive chunks of chunkFrames frames,
+    each read from the file when requested."""
+    numFrames = c3d.numFrames
+    print("Num. frames: %d" % numFrames)
+    progress.setValue(0)
+    for begin in range(0, numFrames, chunkFrames):
+        if progress.wasCanceled():
+            return
+        end = min(begin + chunkFrames, numFrames)
+        rd = RawData.fromRagged(*c3d.validPoints(begin, end))
+        rd.filename = c3d.filename
+        rd.frameRate = c3d.header.frameRate
+        progress.setValue( int(100.0*end / numFrames) )
+        yield rd
+
 # CSV
 #####
 
+# Lines parsed at a time by the CSV importers
+csvChunkLines = 10000
+
 def rawDataFromCSV(filename, progress):
+    chunks = list(rawChunksFromCSV(filename, progress))
+    if progress.wasCanceled():
+        return
+    rd = RawData.fromCounts([c.points for c in chunks],
+                            [c.pointCounts for c in chunks])
+    rd.filename = filename
+    rd.frameRate = 100.0
+    progress.setValue(100)
+    return rd
+
+def rawChunksFromCSV(filename, progress):
+    "Raw data of a CSV file in consecutive chunks of frames, read as requested"
     with open(filename) as pointsfile:
         framecount = 100
-        rd = RawData()
-        rd.filename = filename
-        rd.frameRate = 100.0
-
-        for line in pointsfile:
-            line_array = line.split(',')
-            if (line_array[0] == 'info'):
-                if (line_array[1] == 'framecount'):
-                    framecount = int(line_array[2])
-            if (line_array[0] == 'frame'):
-                i = len(rd.frames)
-                if i % 1000 == 0:
-                    progress.setValue( int(100.0*i / framecount) )
-                if progress.wasCanceled():
-                    return
-                try:
-                    rd.frames.append(readFrameFromArray(line_array, i))
-                except:
-                   print('Error appending frame %d of %d' % (i, framecount))
-                   break
-        progress.setValue(100)
+        numFrames = 0
+        failed = False
+
+        while not failed:
+            lines = list(itertools.islice(pointsfile, csvChunkLines))
+            if len(lines) == 0:
+                break
+            rows = []
+            for line in lines:
+                line_array = line.split(',')
+                if (line_array[0] == 'info'):
+                    if (line_array[1] == 'framecount'):
+                        framecount = int(line_array[2])
+                if (line_array[0] == 'frame'):
+                    rows.append(line_array)
+            progress.setValue( int(100.0*numFrames / framecount) )
+            if progress.wasCanceled():
+                return
+            try:
+                data, frameCounts = readFramesFromArrays(rows)
+            except:
+                # Parse one frame at a time up to the faulty one
+                frames = []
+                for row in rows:
+                    try:
+                        frames.append(readFrameFromArray(row, numFrames + len(frames)))
+                    except:
+                        print('Error appending frame %d of %d' %
+                              (numFrames + len(frames), framecount))
+                        failed = True
+                        break
+                data = np.zeros((0, 3), np.float32)
+                if len(frames) > 0:
+                    data = np.concatenate([f.data for f in frames])
+                frameCounts = np.array([f.numPoints for f in frames], np.int64)
+            numFrames += len(frameCounts)
+            if len(frameCounts) > 0:
+                rd = RawData.fromCounts([data], [frameCounts])
+                rd.filename = filename
+                rd.frameRate = 100.0
+                yield rd
     
     if (not framecount):
         print ('Error frame count not found!')
 
-    return rd
-    
+def readFramesFromArrays(rows, frame_scale=800):
+    """Valid points of many split 'frame' lines, as a (N, 3) array, and
+    the number of points of each frame. Same output as readFrameFromArray,
+    with coordinates converted in bulk."""
+    counts = np.zeros(len(rows), np.int64)
+    x, y, z = [], [], []
+    for i, line in enumerate(rows):
+        # Skip rigid bodies
+        counter = 4 + int(line[3])
+        marker_count = int(line[counter])
+        counter = counter + 1
+        # x, y, z, id, name for every marker
+        end = counter + 5 * marker_count
+        if marker_count > 0 and len(line) < end - 2:
+            raise IndexError('frame line too short')
+        x.extend(line[counter:end:5])
+        y.extend(line[counter+1:end:5])
+        z.extend(line[counter+2:end:5])
+        counts[i] = marker_count
+    empty = np.count_nonzero(counts == 0)
+    if empty > 0:
+        print ('Warning, markers not found in %d frames' % empty)
+    data = np.zeros((len(x), 3), dtype = np.float32)
+    data[:, 0] = np.array(x, np.float32) * frame_scale
+    data[:, 2] = np.array(y, np.float32) * frame_scale
+    data[:, 1] = np.array(z, np.float32) * -1 * frame_scale
+    return data, counts
+
 def readFrameFromArray(line, line_number):
     # This won't be used
     frame_id = int(line[1])
@@ -115,38 +197,82 @@ def readFrameFromArray(line, line_number):
 #######
 
 def rawDataFromCSV2(filename, progress):
+    chunks = list(rawChunksFromCSV2(filename, progress))
+    if progress.wasCanceled():
+        return
+    rd = RawData.fromCounts([c.points for c in chunks],
+                            [c.pointCounts for c in chunks])
+    rd.filename = filename
+    rd.frameRate = chunks[0].frameRate if chunks else None
+    progress.setValue(100)
+    print("Framerate:", rd.frameRate)
+    return rd
+
+def rawChunksFromCSV2(filename, progress):
+    "Raw data of a CSV2 file in consecutive chunks of frames, read as requested"
     with open(filename) as pointsfile:
         framecount = 100
-        rd = RawData()
-        rd.filename = filename
-        rd.frameRate = None
-        counter = 0
-
-        for line in pointsfile:
-            counter = counter + 1
-            # Line with the information
-            if (counter == 1):
-                line_array = line.strip(' \n\r\t').split(',')
-                metadata = dict(zip(line_array[::2], line_array[1::2]))
-                framecount = int(metadata['Total Exported Frames'])
-                rd.frameRate = float(metadata['Export Frame Rate'])
-            # Line containing a frame
-            if (counter > 7):
-                line_array = line.split(',')
-                i = len(rd.frames)
-                if i % 1000 == 0:
-                    progress.setValue( int(100.0*i / framecount) )
-                if progress.wasCanceled():
-                    return
-                rd.frames.append(readFrameFromArray2(line_array, i))
-        progress.setValue(100)
+        frameRate = None
+        numFrames = 0
+
+        # Line with the information
+        line_array = pointsfile.readline().strip(' \n\r\t').split(',')
+        metadata = dict(zip(line_array[::2], line_array[1::2]))
+        framecount = int(metadata['Total Exported Frames'])
+        frameRate = float(metadata['Export Frame Rate'])
+        # Column headers
+        for i in range(6):
+            pointsfile.readline()
+
+        # Lines containing frames
+        while True:
+            lines = list(itertools.islice(pointsfile, csvChunkLines))
+            if len(lines) == 0:
+                break
+            progress.setValue( int(100.0*numFrames / framecount) )
+            if progress.wasCanceled():
+                return
+            try:
+                data, frameCounts = readFramesFromLines2(lines)
+            except:
+                frames = [readFrameFromArray2(line.split(','), numFrames + i)
+                          for i, line in enumerate(lines)]
+                data = np.zeros((0, 3), np.float32)
+                if len(frames) > 0:
+                    data = np.concatenate([f.data for f in frames])
+                frameCounts = np.array([f.numPoints for f in frames], np.int64)
+            numFrames += len(frameCounts)
+            rd = RawData.fromCounts([data], [frameCounts])
+            rd.filename = filename
+            rd.frameRate = frameRate
+            yield rd
     
     if (not framecount):
         print ('Error frame count not found!')
 
-    print("Framerate:", rd.frameRate)
-    return rd
-    
+# Empty cell, which readFramesFromLines2 turns into nan
+emptyCell = re.compile(r',(?=,|[ \t\r]*$)', re.M)
+
+def readFramesFromLines2(lines, frame_scale=800):
+    """Valid points of many frame lines, as a (N, 3) array, and the number
+    of points of each frame. Same output as readFrameFromArray2, parsing
+    the whole numeric block at once; empty cells are missing markers."""
+    text = emptyCell.sub(',nan', ''.join(lines))
+    block = np.loadtxt(io.StringIO(text), delimiter=',', comments=None,
+                       ndmin=2)
+    # Skip frame number and time stamp
+    values = block[:, 2:]
+    present = ~np.isnan(values)
+    counts = np.count_nonzero(present, axis=1)
+    if np.any(counts % 3):
+        raise RawDataReadError('incomplete marker coordinates')
+    xyz = values[present].astype(np.float32).reshape(-1, 3)
+    data = np.zeros((len(xyz), 3), dtype = np.float32)
+    data[:, 0] = xyz[:, 0] * frame_scale
+    data[:, 2] = xyz[:, 1] * frame_scale
+    data[:, 1] = xyz[:, 2] * -1 * frame_scale
+    return data, counts // 3
+
 def readFrameFromArray2(line_array, line_number):
     '''
     - line_array is an array that in each cell stores a string float or an empty
@@ -193,11 +319,213 @@ def readFrameFromArray2(line_array, line_number):
 # HDF5
 ######
 
-def trajDataFromH5(filename, progress=None):
-    """Read data from hdf5 file"""
+def decodeAttr(value):
+    "Attribute as str, whether h5py returns it as str or bytes."
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    value = str(value)
+    if value.startswith("b'") and value.endswith("'"):
+        value = value[2:-1]
+    return value
+
+def partFilter(parts):
+    "Predicate on trajectory names, true for names starting with any of parts."
+    if parts is None:
+        return lambda name: True
+    parts = tuple(parts)
+    return lambda name: name.startswith(parts)
+
+def readTrajsDots0(group, progress=None, parts=None):
+    """Read 'dots 0' trajectories (one dataset per trajectory).
+
+    All samples are read with one read_direct per dataset into a single
+    preallocated block, and trajectories are views into that block.
+    Progress is reported by bytes read. If parts is given, only
+    trajectories whose name starts with one of them are read. Returns
+    trajectories and their dataset names.
+    """
+    keep = partFilter(parts)
+    keys = [k for k in group if keep(decodeAttr(group[k].attrs['name']))]
+    dsets = [group[k] for k in keys]
+    lengths = np.array([d.shape[0] for d in dsets], dtype=int)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    block = np.empty((offsets[-1], 3), dtype=Traj.dtype)
+    totalBytes = max(1, offsets[-1] * 3 * 4)
+    trajs = []
+    percent = -1
+    for i, dset in enumerate(dsets):
+        samples = block[offsets[i]:offsets[i+1]]
+        if lengths[i] > 0:
+            dset.read_direct(samples)
+        tr = Traj(int(dset.attrs['begin_frame']), decodeAttr(dset.attrs['name']))
+        tr.pointData = samples
+        trajs.append(tr)
+        if progress is not None and \
+           int(100.0 * offsets[i+1] * 3 * 4 / totalBytes) != percent:
+            percent = int(100.0 * offsets[i+1] * 3 * 4 / totalBytes)
+            progress.setValue(percent)
+    return trajs, keys
+
+def packedIndex(group):
+    "Offsets, begin frames, names and averages of a 'dots 1' group."
+    offsets = group['offsets'][()].astype(int)
+    beginFrames = group['begin_frame'][()].astype(int)
+    names = [decodeAttr(n) for n in group['name'][()]]
+    averages = group['average'][()] if 'average' in group else None
+    return offsets, beginFrames, names, averages
+
+def readTrajsDots1(group, progress=None, parts=None, blockRows=1000000):
+    """Read 'dots 1' trajectories (all samples packed in one dataset).
+
+    Without a parts filter the whole sample dataset is read in blocks of
+    blockRows rows (reporting progress by bytes read); with a filter only
+    the ranges of selected trajectories are read. Returns trajectories and
+    their sample ranges in the file.
+    """
+    keep = partFilter(parts)
+    offsets, beginFrames, names, averages = packedIndex(group)
+    dset = group['samples']
+    selected = [i for i in range(len(names)) if keep(names[i])]
+    if len(selected) == len(names):
+        block = np.empty(dset.shape, dtype=Traj.dtype)
+        total = max(1, dset.shape[0])
+        for start in range(0, dset.shape[0], blockRows):
+            stop = min(start + blockRows, dset.shape[0])
+            dset.read_direct(block, np.s_[start:stop], np.s_[start:stop])
+            if progress is not None:
+                progress.setValue( int(100.0 * stop / total) )
+        ranges = [(offsets[i], offsets[i+1]) for i in selected]
+    else:
+        lengths = np.array([offsets[i+1] - offsets[i] for i in selected],
+                           dtype=int)
+        blockOffsets = np.concatenate(([0], np.cumsum(lengths)))
+        block = np.empty((blockOffsets[-1], 3), dtype=Traj.dtype)
+        ranges = list(zip(blockOffsets[:-1], blockOffsets[1:]))
+        for (a, b), i in zip(ranges, selected):
+            if b > a:
+                dset.read_direct(block, np.s_[offsets[i]:offsets[i+1]],
+                                 np.s_[a:b])
+    trajs = []
+    for (a, b), i in zip(ranges, selected):
+        tr = Traj(int(beginFrames[i]), names[i])
+        tr.pointData = block[a:b]
+        trajs.append(tr)
+    return trajs, [(offsets[i], offsets[i+1]) for i in selected]
+
+class H5TrajStore:
+    """Keeps a .qtd file open and loads trajectory samples on demand.
+
+    Loaded samples are kept in a least recently used cache holding at most
+    maxSamples samples (the most recent trajectory is always kept).
+    """
+
+    def __init__(self, filename, maxSamples=20000000):
+        self.filename = filename
+        self.maxSamples = maxSamples
+        self.reopen()
+
+    def reopen(self):
+        "(Re)open the file, e.g. after it was modified or replaced."
+        self.file = h5py.File(self.filename, 'r')
+        self.group = self.file['trajectories']
+        # In 'dots 1' files keys are sample ranges, otherwise dataset names
+        self.packed = 'samples' in self.group
+        self.resident = OrderedDict()
+        self.numResident = 0
+
+    def load(self, traj):
+        data = self.resident.get(traj.key)
+        if data is not None:
+            self.resident.move_to_end(traj.key)
+            return data
+        if self.packed:
+            begin, end = traj.key
+            data = np.empty((end - begin, 3), dtype=Traj.dtype)
+            if end > begin:
+                self.group['samples'].read_direct(data, np.s_[begin:end])
+        else:
+            dset = self.group[traj.key]
+            data = np.empty(dset.shape, dtype=Traj.dtype)
+            if data.shape[0] > 0:
+                dset.read_direct(data)
+        self.resident[traj.key] = data
+        self.numResident += data.shape[0]
+        while self.numResident > self.maxSamples and len(self.resident) > 1:
+            key, old = self.resident.popitem(last=False)
+            self.numResident -= old.shape[0]
+        return data
+
+    def readSlice(self, traj, begin, end):
+        "Samples begin to end (relative to trajectory start) without caching."
+        data = self.resident.get(traj.key)
+        if data is not None:
+            return data[begin:end]
+        if self.packed:
+            first = traj.key[0]
+            return self.group['samples'][first+begin:first+end].astype(Traj.dtype)
+        return self.group[traj.key][begin:end].astype(Traj.dtype)
+
+    def release(self, traj):
+        data = self.resident.pop(traj.key, None)
+        if data is not None:
+            self.numResident -= data.shape[0]
+
+    @property
+    def isOpen(self):
+        return bool(self.file.id.valid)
+
+    def close(self):
+        self.resident.clear()
+        self.numResident = 0
+        self.file.close()
+
+    def __deepcopy__(self, memo):
+        # Deep copies of lazy trajectories are plain in-memory trajectories
+        return None
+
+
+def lazyTrajsDots0(store, parts=None):
+    "LazyTraj objects for 'dots 0' datasets, reading attributes only."
+    keep = partFilter(parts)
+    trajs = []
+    for dsetName in store.group:
+        dset = store.group[dsetName]
+        name = decodeAttr(dset.attrs['name'])
+        if not keep(name):
+            continue
+        average = dset.attrs.get('average')
+        trajs.append(LazyTraj(store, dsetName, int(dset.attrs['begin_frame']),
+                              name, dset.shape[0], average))
+    return trajs
+
+def lazyTrajsDots1(store, parts=None):
+    "LazyTraj objects for a 'dots 1' file, reading the index table only."
+    keep = partFilter(parts)
+    offsets, beginFrames, names, averages = packedIndex(store.group)
+    trajs = []
+    for i in range(len(names)):
+        if keep(names[i]):
+            average = None if averages is None else averages[i]
+            trajs.append(LazyTraj(store, (offsets[i], offsets[i+1]),
+                                  int(beginFrames[i]), names[i],
+                                  offsets[i+1] - offsets[i], average))
+    return trajs
+
+def trajDataFromH5(filename, progress=None, lazy=False, parts=None):
+    """Read data from hdf5 file
+
+    With lazy=True the file is kept open and only attributes are read now;
+    trajectory samples are read when first used (see H5TrajStore). If parts
+    is a list of name prefixes (e.g. ['UB', 'LB']) only matching
+    trajectories are loaded.
+    """
     td = TrajData()
     td.filename = filename
-    source = h5py.File(filename, 'r')
+    if lazy:
+        td.store = H5TrajStore(filename)
+        source = td.store.file
+    else:
+        source = h5py.File(filename, 'r')
     group = source['trajectories']
     if not 'frame_rate' in group.attrs:
         print("Warning, no framerate specified. Setting to 100 FPS.")
@@ -209,59 +537,487 @@ def trajDataFromH5(filename, progress=None):
     if not 'format_version' in group.attrs:
         print("Warning, no format version specified. Save to correct.")
         td.changed = True
-    totalTrajs = len(list(group))        # Find number of trajectories
-    for dsetName in list(group):
-        dset = group[dsetName]
-        tr = Traj(int(dset.attrs['begin_frame']), str(dset.attrs['name']))
-        if tr.name.startswith("b'") and tr.name.endswith("'"):
-            tr.name = tr.name[2:-1]
-        tr.pointData = [np.array(p) + np.array([0, 0, 0]) for p in  dset.value.tolist()]
-        td.trajs.append(tr)
-        if progress is not None:
-            progress.setValue( int(100.0*td.numTrajs / totalTrajs) )
-    source.close()
+    else:
+        td.formatVersion = decodeAttr(group.attrs['format_version'])
+    packed = 'samples' in group
+    if lazy:
+        lazyTrajs = lazyTrajsDots1 if packed else lazyTrajsDots0
+        td.trajs.extend(lazyTrajs(td.store, parts))
+        keys = [t.key for t in td.trajs]
+    else:
+        readTrajs = readTrajsDots1 if packed else readTrajsDots0
+        trajs, keys = readTrajs(group, progress, parts)
+        td.trajs.extend(trajs)
+        source.close()
     del source
+    if parts is None and td.formatVersion is not None:
+        td.savedState = SavedState(filename, td.formatVersion, td.trajs, keys)
     if progress is not None:
         progress.setValue(100)
     return td
 
-def trajToH5Dataset(h5group, idx, traj):
+def trajToH5Dataset(h5group, key, traj):
     shape = (traj.numFrames, 3)
     dset = h5group.create_dataset(
-        'traj%d' % idx, shape, 'f', compression='gzip', data=traj.pointData)
+        key, shape, 'f', compression='gzip', data=traj.pointData)
     dset.attrs["name"] = traj.name
     dset.attrs["begin_frame"] = traj.beginFrame
+    if traj.numFrames > 0:
+        dset.attrs["average"] = traj.average()
 
-def trajDataSaveH5(trajData, progress=None):
-    f = h5py.File(trajData.filename, 'w')
-    trajgroup = f.create_group('trajectories')
-    trajgroup.attrs['format_version'] = 'dots 0'
-    trajgroup.attrs['frame_rate'] = trajData.frameRate
-    idx = 0
+class SavedState:
+    """What a .qtd file holds for the trajectories of a TrajData.
+
+    For each trajectory (by identity) keeps its key in the file (dataset
+    name for 'dots 0', sample range for 'dots 1') and its name, begin frame
+    and revision when it was read or written. Comparing against it tells
+    which trajectories need their data or just attributes rewritten.
+    """
+
+    def __init__(self, filename, formatVersion, trajs, keys):
+        self.filename = filename
+        self.formatVersion = formatVersion
+        self.entries = dict((id(t), (t, k, t.name, t.beginFrame, t.revision))
+                            for t, k in zip(trajs, keys))
+
+    def matches(self, filename, formatVersion):
+        return self.formatVersion == formatVersion and \
+               os.path.exists(filename) and os.path.exists(self.filename) and \
+               os.path.samefile(self.filename, filename)
+
+    def entry(self, traj):
+        "Returns (key, name, beginFrame, revision) or None if not saved."
+        e = self.entries.get(id(traj))
+        if e is None or e[0] is not traj:
+            return None
+        return e[1:]
+
+    def removed(self, trajs):
+        "Saved trajectories no longer in trajs."
+        current = set(id(t) for t in trajs)
+        return [e[0] for i, e in self.entries.items() if not i in current]
+
+def openStores(trajData, filename):
+    "Open stores of lazy trajectories of trajData reading from filename."
+    stores = set([t.store for t in trajData.trajs + trajData.trash
+                  if isinstance(t, LazyTraj)] + [trajData.store])
+    return [s for s in stores if s is not None and s.isOpen and
+            os.path.samefile(s.filename, filename)]
+
+def pinLazy(trajs, stores):
+    for t in trajs:
+        if isinstance(t, LazyTraj) and t.store in stores:
+            t.pin()
+
+def updateDots0(trajData, group, saved, progress=None):
+    """Update a 'dots 0' group in place to match trajData.
+
+    Only datasets of trajectories with modified samples are rewritten;
+    renamed or shifted trajectories get their attributes updated, removed
+    ones are deleted and new ones added.
+    """
+    for t in saved.removed(trajData.trajs):
+        del group[saved.entry(t)[0]]
+    used = set(group.keys())
+    nextIdx = len(used) + 1
+    keys = []
     numTrajs = trajData.numTrajs
-    for traj in trajData.trajs:
-        idx += 1
-        trajToH5Dataset(trajgroup, idx, traj)
+    for i, t in enumerate(trajData.trajs):
+        e = saved.entry(t)
+        if e is not None and e[3] == t.revision:
+            key = e[0]
+            if e[1] != t.name:
+                group[key].attrs['name'] = t.name
+            if e[2] != t.beginFrame:
+                group[key].attrs['begin_frame'] = t.beginFrame
+        else:
+            if e is not None:
+                key = e[0]
+                del group[key]
+            else:
+                while ('traj%d' % nextIdx) in used:
+                    nextIdx += 1
+                key = 'traj%d' % nextIdx
+                used.add(key)
+            trajToH5Dataset(group, key, t)
+        keys.append(key)
         if progress is not None:
-            progress.setValue( int(100.0 * idx / numTrajs) )
+            progress.setValue( int(100.0 * (i+1) / numTrajs) )
+    return keys
+
+def updateDots1(trajData, group, saved):
+    """Update names and begin frames of a 'dots 1' group in place.
+
+    Returns keys, or None if samples or the trajectory list changed (the
+    file must be rewritten then).
+    """
+    offsets = group['offsets'][()]
+    keys = []
+    for t in trajData.trajs:
+        e = saved.entry(t)
+        if e is None or e[3] != t.revision:
+            return None
+        keys.append(e[0])
+    starts = [k[0] for k in keys]
+    if len(keys) != len(offsets) - 1 or starts != list(offsets[:-1]):
+        return None
+    del group['name']
+    group.create_dataset('name', data=[t.name for t in trajData.trajs],
+                         dtype=h5py.special_dtype(vlen=str))
+    group['begin_frame'][...] = [t.beginFrame for t in trajData.trajs]
+    return keys
+
+def updateH5(trajData, formatVersion, compression='lzf', progress=None,
+             maxRewrite=0.5, maxWaste=0.25):
+    """Save changes only, modifying trajData.filename in place.
+
+    Returns new keys, or None if the file must be fully rewritten: it was
+    not read or written from trajData, it has another format or (for
+    'dots 1') another sample compression, more than
+    maxRewrite of the samples changed, or the space of datasets deleted by
+    in place updates (which HDF5 never reuses) would exceed maxWaste of the
+    file size.
+
+    Unlike rewriteH5, an update interrupted halfway can leave the file
+    inconsistent.
+    """
+    saved = trajData.savedState
+    filename = trajData.filename
+    if saved is None or not saved.matches(filename, formatVersion):
+        return None
+    total = sum([t.numFrames for t in trajData.trajs])
+    changed = sum([t.numFrames for t in trajData.trajs
+                   if saved.entry(t) is None or
+                   saved.entry(t)[3] != t.revision])
+    if changed > maxRewrite * total:
+        return None
+    # Removed trajectories may be needed later (undelete)
+    stores = openStores(trajData, filename)
+    pinLazy(saved.removed(trajData.trajs) + trajData.trash, stores)
+    for store in stores:
+        store.close()
+    f = h5py.File(filename, 'r+')
+    try:
+        group = f['trajectories']
+        if formatVersion == 'dots 1' and group['samples'].compression != \
+                packedFilters[compression].get('compression'):
+            return None
+        # Datasets to be deleted and written again
+        if formatVersion == 'dots 1':
+            freed = ['name']
+        else:
+            freed = [saved.entry(t)[0] for t in saved.removed(trajData.trajs)] + \
+                    [saved.entry(t)[0] for t in trajData.trajs
+                     if saved.entry(t) is not None and
+                     saved.entry(t)[3] != t.revision]
+        wasted = int(group.attrs.get('freed_bytes', 0)) + \
+            sum([group[k].id.get_storage_size() for k in freed if k in group])
+        if wasted > maxWaste * os.path.getsize(filename):
+            return None
+        group.attrs['frame_rate'] = trajData.frameRate
+        if formatVersion == 'dots 1':
+            keys = updateDots1(trajData, group, saved)
+        else:
+            keys = updateDots0(trajData, group, saved, progress)
+        if keys is not None:
+            group.attrs['freed_bytes'] = wasted
+    finally:
+        f.close()
+        for store in stores:
+            store.reopen()
+    return keys
+
+def writeH5(filename, trajs, frameRate, formatVersion, compression='lzf',
+            progress=None):
+    "Write a new file; returns the key of each trajectory."
+    f = h5py.File(filename, 'w')
+    trajgroup = f.create_group('trajectories')
+    trajgroup.attrs['format_version'] = formatVersion
+    trajgroup.attrs['frame_rate'] = frameRate
+    if formatVersion == 'dots 1':
+        offsets = trajsToPackedDatasets(trajgroup, trajs, compression,
+                                        progress=progress)
+        keys = list(zip(offsets[:-1], offsets[1:]))
+    else:
+        keys = []
+        numTrajs = len(trajs)
+        for traj in trajs:
+            keys.append('traj%d' % (len(keys) + 1))
+            trajToH5Dataset(trajgroup, keys[-1], traj)
+            if progress is not None:
+                progress.setValue( int(100.0 * len(keys) / numTrajs) )
     f.flush()
     f.close()
     del f
+    return keys
+
+def replaceFile(tmpname, filename):
+    """Rename tmpname over filename atomically. The new file keeps the mode
+    of the one it replaces or, if there was none, gets the default mode of
+    new files (tempfile.mkstemp creates files readable by their owner only).
+    """
+    if os.path.exists(filename):
+        shutil.copymode(filename, tmpname)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpname, 0o666 & ~umask)
+    os.replace(tmpname, filename)
+
+def rewriteH5(trajData, formatVersion, compression='lzf', progress=None):
+    """Write the whole file to a temporary file next to it, then rename it
+    over the original, so that an interrupted save leaves the old file
+    untouched. Lazy trajectories read from the old file are moved to the
+    new one."""
+    filename = trajData.filename
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(suffix='.qtd', dir=dirname)
+    os.close(fd)
+    try:
+        keys = writeH5(tmpname, trajData.trajs, trajData.frameRate,
+                       formatVersion, compression, progress)
+        if os.path.exists(filename):
+            stores = openStores(trajData, filename)
+        else:
+            stores = []
+    except:
+        os.remove(tmpname)
+        raise
+    # Trajectories not written to the new file must not depend on the old one
+    current = set(id(t) for t in trajData.trajs)
+    pinLazy([t for t in trajData.trash if not id(t) in current], stores)
+    for store in stores:
+        store.close()
+    replaceFile(tmpname, filename)
+    for store in stores:
+        store.reopen()
+        for t, k in zip(trajData.trajs, keys):
+            if isinstance(t, LazyTraj) and t.store is store and not t.pinned:
+                t.key = k
+    return keys
+
+# Format written for data not read from file (see TrajData.formatVersion)
+defaultFormatVersion = 'dots 0'
+
+# Filters for 'dots 1' sample data
+packedFilters = {
+    'lzf':  dict(compression='lzf'),
+    'gzip': dict(compression='gzip', compression_opts=1, shuffle=True),
+    None:   dict(),
+}
+
+def trajsToPackedDatasets(h5group, trajs, compression='lzf', chunkRows=4096,
+                          progress=None):
+    """Write trajectories as 'dots 1': one (totalSamples, 3) sample dataset
+    plus offsets, begin_frame, name and average index datasets.
+
+    Samples are chunked in blocks of chunkRows rows, so reading one
+    trajectory or a frame window touches few, small chunks. Returns sample
+    offsets of trajectories.
+    """
+    lengths = np.array([t.numFrames for t in trajs], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    total = int(offsets[-1])
+    samples = h5group.create_dataset(
+        'samples', (total, 3), 'f', chunks=(max(1, min(chunkRows, total)), 3),
+        maxshape=(None, 3), **packedFilters[compression])
+    # Write whole trajectories, up to about 64 chunks at a time
+    numTrajs = len(trajs)
+    first = 0
+    while first < numTrajs:
+        last = first + 1
+        while last < numTrajs and offsets[last+1] - offsets[first] <= 64*chunkRows:
+            last += 1
+        if offsets[last] > offsets[first]:
+            samples[offsets[first]:offsets[last]] = np.concatenate(
+                [t.pointData for t in trajs[first:last]])
+        first = last
+        if progress is not None:
+            progress.setValue( int(100.0 * last / numTrajs) )
+    h5group.create_dataset('offsets', data=offsets)
+    h5group.create_dataset('begin_frame', data=np.array(
+        [t.beginFrame for t in trajs], dtype=np.int64))
+    h5group.create_dataset('name', data=[t.name for t in trajs],
+                           dtype=h5py.special_dtype(vlen=str))
+    averages = np.zeros((numTrajs, 3), dtype=np.float32)
+    for i, t in enumerate(trajs):
+        if t.numFrames > 0:
+            averages[i] = t.average()
+    h5group.create_dataset('average', data=averages)
+    return offsets
+
+def trajDataSaveH5(trajData, progress=None, formatVersion=None,
+                   compression='lzf'):
+    """Write trajectories to trajData.filename.
+
+    formatVersion is 'dots 0' (one dataset per trajectory) or 'dots 1'
+    (packed, see trajsToPackedDatasets, with given compression: 'lzf',
+    'gzip' or None). By default the format of trajData is kept.
+
+    If the file was read or last written from trajData, only changes are
+    saved (see updateH5). Otherwise the file is rewritten atomically (see
+    rewriteH5).
+    """
+    if formatVersion is None:
+        formatVersion = trajData.formatVersion or defaultFormatVersion
+    keys = updateH5(trajData, formatVersion, compression, progress)
+    if keys is None:
+        keys = rewriteH5(trajData, formatVersion, compression, progress)
+    trajData.formatVersion = formatVersion
+    trajData.savedState = SavedState(trajData.filename, formatVersion,
+                                     trajData.trajs, keys)
     if progress is not None:
         progress.setValue(100)
 
+def convertFolder(folder, formatVersion='dots 1', compression='lzf'):
+    "Rewrite all .qtd files under folder in given format."
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for fn in filenames:
+            if fn.endswith(".qtd"):
+                fullfn = os.path.join(dirpath, fn)
+                print("Converting '%s'" % fullfn)
+                td = trajDataFromH5(fullfn)
+                trajDataSaveH5(td, None, formatVersion, compression)
+
 
 # Raw to trajectorized data
 ###########################
 
-def trajDataFromRawData(rdata, progress):
-    t = tz.Trajectorizer(rdata, progress)
+def trajDataFromRawData(rdata, progress, tracker='greedy', workers=1):
+    t = tz.Trajectorizer(rdata, progress, tracker, workers)
     t.trajectorize()
     td = TrajData()
     td.frameRate = rdata.frameRate
     td.filename = rdata.filename + '.qtd'
+    td.formatVersion = 'dots 1'  # Raw files have many short fragments
     td.trajs.extend(t.trajs)
     td.rename()
     mops.guessSideAndSubject(td)
     mops.sortTrajs(td)
     return td
+
+class PackedTrajWriter:
+    """Writes a new 'dots 1' file from blocks of trajectory samples given
+    in any order, keeping in memory only where the blocks are.
+
+    Blocks are appended to a scratch file next to the output. close names
+    trajectories after their side and subject, sorts them by mean x and
+    writes the output, reading one trajectory at a time back from the
+    scratch file, which is then removed.
+    """
+
+    def __init__(self, filename, frameRate):
+        self.filename = filename
+        self.frameRate = frameRate
+        dirname = os.path.dirname(os.path.abspath(filename))
+        fd, self.scratchName = tempfile.mkstemp(suffix='.samples', dir=dirname)
+        self.scratch = os.fdopen(fd, 'wb')
+        self.blocks = OrderedDict()  # Begin frame and blocks by key
+        self.numSamples = 0
+
+    def write(self, key, beginFrame, samples):
+        "Appends samples to the trajectory identified by key"
+        samples = np.ascontiguousarray(samples, Traj.dtype)
+        self.scratch.write(samples.tobytes())
+        self.blocks.setdefault(key, (beginFrame, []))[1].append(
+            (self.numSamples, len(samples)))
+        self.numSamples += len(samples)
+
+    def close(self, progress=None):
+        """Writes trajectories in order of mean x, then of key, as
+        modelops.sortTrajs does for trajectories listed by key."""
+        self.scratch.close()
+        try:
+            samples = np.zeros((0, 3), Traj.dtype)
+            if self.numSamples > 0:
+                samples = np.memmap(self.scratchName, Traj.dtype, 'r',
+                                    shape=(self.numSamples, 3))
+            trajs = []
+            for key, (beginFrame, blocks) in self.blocks.items():
+                t = ScratchTraj(beginFrame, samples, blocks)
+                trajs.append(((t.averageX(), key), t))
+            trajs = [t for k, t in sorted(trajs, key=lambda e: e[0])]
+            dirname = os.path.dirname(os.path.abspath(self.filename))
+            fd, tmpname = tempfile.mkstemp(suffix='.qtd', dir=dirname)
+            os.close(fd)
+            try:
+                writeH5(tmpname, trajs, self.frameRate, 'dots 1',
+                        progress=progress)
+            except:
+                os.remove(tmpname)
+                raise
+            replaceFile(tmpname, self.filename)
+            del trajs, samples
+        finally:
+            os.remove(self.scratchName)
+
+    def abort(self):
+        self.scratch.close()
+        os.remove(self.scratchName)
+
+class ScratchTraj:
+    """Trajectory written by PackedTrajWriter, with samples read from the
+    scratch file when needed. Name and averages are computed once, from a
+    Traj, so they are the same as for the trajectory in memory."""
+
+    def __init__(self, beginFrame, samples, blocks):
+        self.beginFrame = beginFrame
+        self.samples = samples
+        self.blocks = blocks
+        self.numFrames = sum([n for first, n in blocks])
+        t = Traj(beginFrame)
+        t.pointData = self.pointData
+        mops.guessTrajSideAndSubject(t)
+        self.name = t.name
+        self._average = t.average()
+        self._averageX = t.averageX()
+
+    @property
+    def pointData(self):
+        return np.concatenate([self.samples[first:first+n]
+                               for first, n in self.blocks])
+
+    def average(self):
+        return self._average
+
+    def averageX(self):
+        return self._averageX
+
+def trajDataStreamToH5(chunks, progress, tracker='greedy'):
+    """Trajectorize raw data given as consecutive chunks of frames (see
+    rawChunksFromC3D) into a 'dots 1' file named after the raw file.
+
+    Frames flow through close point merging and tracking as chunks are
+    read, and trajectory samples are written out as soon as they are
+    final (see Trajectorizer.streamTrajectorize), so memory holds the
+    chunk being read and the trajectories still being tracked or matched.
+    The file is the same trajDataFromRawData and trajDataSaveH5 would
+    write. Tracking runs in this process (the process pool of
+    trajDataFromRawData splits whole recordings, not a stream). Returns the
+    file name, or None if canceled or without frames.
+    """
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        return
+
+    def merged():
+        for rd in itertools.chain([first], chunks):
+            rd.joinClosePoints(None)
+            yield rd
+
+    t = tz.Trajectorizer(None, None, tracker)
+    writer = PackedTrajWriter(first.filename + '.qtd', first.frameRate)
+    try:
+        for blocks in t.streamTrajectorize(merged()):
+            for position, beginFrame, samples in blocks:
+                writer.write(position, beginFrame, samples)
+    except:
+        writer.abort()
+        raise
+    if progress.wasCanceled():
+        writer.abort()
+        return
+    progress.setLabelText("Saving trajectorized data...")
+    writer.close(progress)
+    return writer.filename
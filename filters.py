@@ -0,0 +1,147 @@
+# Copyright 2012 Esteban Hurtado
+#
+# This file is part of Cutedots.
+#
+# Cutedots is distributed under the terms of the Reciprocal Public License 1.5.
+#
+# Cutedots is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the Reciprocal Public License 1.5 for more details.
+#
+# You should have received a copy of the Reciprocal Public License along with
+# Cutedots. If not, see <http://opensource.org/licenses/rpl-1.5>.
+
+"""Filters for signals sampled at a frame rate.
+
+Signals are arrays with time along the first axis and any number of
+channels along the others (for instance (frames, 3) trajectory samples or
+(frames, trajectories, 3) stacks of them), all filtered in one call.
+"""
+
+from collections import OrderedDict
+import numpy as np
+import scipy.signal as sig
+
+kinds = OrderedDict([
+    ('lowpass', 'Cascade of single pole low pass filters'),
+    ('butter', 'Butterworth low pass'),
+    ('bandpass', 'Butterworth band pass'),
+    ('movavg', 'Moving average'),
+])
+
+defaultOrders = {'lowpass': 4, 'butter': 2, 'bandpass': 2, 'movavg': 1}
+
+designs = {}
+
+class Design:
+    """Coefficients of a filter, either second order sections (sos) or FIR
+    taps (fir), and the state of each section for a unit constant input."""
+    def __init__(self, sos=None, fir=None):
+        self.sos = sos
+        self.fir = fir
+        if sos is not None:
+            self.steady = sig.sosfilt_zi(sos)
+        else:
+            # lfilter_zi rejects single taps; for FIR taps the state is just
+            # the sum of the remaining taps (empty for a single one)
+            self.steady = np.cumsum(fir[::-1])[::-1][1:]
+
+def design(kind, cutoff, framerate, order=None):
+    """Filter design, memoized by its parameters.
+
+    kind      -- One of the names in kinds.
+    cutoff    -- In Hz. For 'lowpass' it is the frequency Fc of each single
+                 pole y[n] = (1-h) x[n] + h y[n-1], with h = exp(-2 pi Fc /
+                 framerate). For 'bandpass' it is a (low, high) pair. For
+                 'movavg' it is the window width in seconds.
+    framerate -- Samples per second. With framerate 1, cutoff for 'movavg'
+                 is the window width in samples.
+    order     -- Number of poles for 'lowpass' (default 4), Butterworth order
+                 for 'butter' and 'bandpass' (default 2), ignored otherwise.
+    """
+    if not kind in kinds:
+        raise ValueError("Unknown filter kind: " + str(kind))
+    if order is None:
+        order = defaultOrders[kind]
+    if np.ndim(cutoff) > 0:
+        cutoff = tuple(float(c) for c in cutoff)
+    else:
+        cutoff = float(cutoff)
+    key = (kind, cutoff, float(framerate), order)
+    if key in designs:
+        return designs[key]
+    if kind == 'lowpass':
+        h = np.exp(-2.0 * np.pi * cutoff / framerate)
+        result = Design(sos=np.tile([1.0 - h, 0.0, 0.0, 1.0, -h, 0.0],
+                                    (order, 1)))
+        # State h x for each pole, computed directly to match the recursion
+        result.steady = np.tile([h, 0.0], (order, 1))
+    elif kind in ['butter', 'bandpass']:
+        btype = 'lowpass' if kind == 'butter' else 'bandpass'
+        result = Design(sos=sig.butter(order, cutoff, btype, fs=framerate,
+                                       output='sos'))
+    elif kind == 'movavg':
+        width = max(1, int(round(cutoff * framerate)))
+        result = Design(fir=np.ones(width) / width)
+    designs[key] = result
+    return result
+
+
+class Filter:
+    """Filter over signals with time along the first axis.
+
+    process() filters consecutive chunks of a long recording, keeping the
+    filter state between them. Unless steady is False, the filter starts
+    as if the first sample had been the input forever, otherwise it starts
+    at rest (zero state). apply() filters a whole signal, optionally
+    forward and then backward for zero phase.
+    """
+    def __init__(self, kind, cutoff, framerate, order=None, steady=True):
+        self.design = design(kind, cutoff, framerate, order)
+        self.steady = steady
+        self.state = None
+
+    def reset(self):
+        "Forget state, so the next chunk starts a new signal."
+        self.state = None
+
+    def initialState(self, first):
+        "State for a signal starting with sample(s) first."
+        shape = self.design.steady.shape + np.shape(first)
+        if not self.steady:
+            return np.zeros(shape)
+        steady = self.design.steady.reshape(
+            self.design.steady.shape + (1,) * np.ndim(first))
+        return steady * first
+
+    def process(self, chunk):
+        "Filters the next chunk of the signal."
+        chunk = np.asarray(chunk, dtype=float)
+        if len(chunk) == 0:
+            return chunk.copy()
+        if self.state is None:
+            self.state = self.initialState(chunk[0])
+        if self.design.sos is not None:
+            y, self.state = sig.sosfilt(self.design.sos, chunk, axis=0,
+                                        zi=self.state)
+        else:
+            y, self.state = sig.lfilter(self.design.fir, [1.0], chunk, axis=0,
+                                        zi=self.state)
+        return y
+
+    def apply(self, signal, zeroPhase=False):
+        """Filters a whole signal. With zeroPhase it is filtered forward and
+        then backward, each pass starting from its own first sample."""
+        self.reset()
+        y = self.process(signal)
+        if zeroPhase:
+            self.reset()
+            y = self.process(y[::-1])[::-1]
+        self.reset()
+        return y
+
+
+def filterSignal(signal, kind, cutoff, framerate, order=None, zeroPhase=False,
+                 steady=True):
+    "Filters a whole signal. See design() and Filter for the arguments."
+    return Filter(kind, cutoff, framerate, order, steady).apply(signal, zeroPhase)
@@ -19,7 +19,6 @@ import os
 from PyQt5 import QtWidgets, QtOpenGL, QtCore, QtGui
 from PyQt5.QtCore import Qt
 import dotsio
-import modelops
 #import rstats
 import actions
 from widgets import *
@@ -196,7 +195,6 @@ class CuteDotsMainWindow(QtWidgets.QMainWindow):
         progress.close()
         progress.destroy()
         del progress
-        modelops.sortTrajs(self.data)
         self.setWindowTitle("Cute dots - " + fn)
 
 
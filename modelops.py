@@ -11,8 +11,10 @@
 # You should have received a copy of the Reciprocal Public License along with
 # Cutedots. If not, see <http://opensource.org/licenses/rpl-1.5>.
 
+from collections import OrderedDict
 from trajdata import Traj
 import numpy as np
+from scipy.linalg import solve_banded
 from trajectorization import Trajectorizer
 
 class ProcessingException(Exception):
@@ -22,25 +24,29 @@ class ProcessingException(Exception):
         return str(self.msg)
 
 
-def matchTrajectories(data, threshold, maxGap, progress=None):
+def matchTrajectories(data, threshold, maxGap, progress=None, minGap=0):
     trz = Trajectorizer(None, progress)
     trz.trajs = data.trajs
     trz.distanceThreshold = threshold
-    trz.match(maxGap)
+    trz.match(maxGap, minGap)
+    data.invalidateIndex()
 
 def guessSideAndSubject(data):
     for t in data.trajs:
-        n = t.name
-        n2 = n[:2]
-        avg = t.average()
-        if avg[0] < 0.0:
-            if avg[1] < 0.0: t.name = n2 + 'R1'
-            else:            t.name = n2 +'L1'
-        else:
-            if avg[1] < 0.0: t.name = n2 + 'L2'
-            else:            t.name = n2 + 'R2'
+        guessTrajSideAndSubject(t)
     data.changed = True
 
+def guessTrajSideAndSubject(t):
+    n = t.name
+    n2 = n[:2]
+    avg = t.average()
+    if avg[0] < 0.0:
+        if avg[1] < 0.0: t.name = n2 + 'R1'
+        else:            t.name = n2 +'L1'
+    else:
+        if avg[1] < 0.0: t.name = n2 + 'L2'
+        else:            t.name = n2 + 'R2'
+
 
 def sortTrajs(data):
     sortTrajsSlow(data)
@@ -48,17 +54,61 @@ def sortTrajs(data):
 def sortTrajsSlow(data):
     data.trajs = sorted(data.trajs, key=lambda t: t.averageX())
 
-def rotate90Deg(data, progress):
+class RigidTransform:
+    """Rotation or reflection plus offset of sample positions,
+    p -> matrix p + translation.
+
+    Transforms compose with then() without touching any data, so a chain of
+    them is applied to trajectories in one pass.
+    """
+    def __init__(self, matrix=None, translation=None):
+        self.matrix = np.eye(3) if matrix is None else \
+            np.array(matrix, dtype=float).reshape((3, 3))
+        self.translation = np.zeros(3) if translation is None else \
+            np.array(translation, dtype=float).reshape(3)
+        self.translated = bool(np.any(self.translation != 0.0))
+
+    def then(self, other):
+        "Transform doing this one first and other after it."
+        return RigidTransform(np.dot(other.matrix, self.matrix),
+                              np.dot(other.matrix, self.translation) +
+                              other.translation)
+
+    def apply(self, points):
+        "Transformed copy of a (n, 3) point array."
+        points = np.dot(points, self.matrix.T)
+        if self.translated:
+            points += self.translation
+        return points
+
+rotation90 = RigidTransform([[0, -1, 0], [1, 0, 0], [0, 0, 1]])
+
+def applyTransform(data, matrix, translation=None, progress=None):
+    """Applies p -> matrix p + translation to every sample of data.
+
+    matrix may also be a RigidTransform, possibly a composition of several,
+    in which case translation is ignored. Each trajectory is transformed
+    with a single matrix product.
+    """
+    if isinstance(matrix, RigidTransform):
+        transform = matrix
+    else:
+        transform = RigidTransform(matrix, translation)
+    if not progress is None:
+        progress.setValue(0)
     trajNum = 0
-    numTrajs = data.numTrajs
+    numTrajs = len(data.trajs)
     for traj in data.trajs:
-        for i in range(traj.numFrames):
-            x, y, z = traj.pointData[i]
-            traj.pointData[i] = -y, x, z
+        traj.pointData = transform.apply(traj.pointData)
         trajNum += 1
-        progress.setValue(int(100.0 * trajNum / numTrajs))
+        if not progress is None and trajNum % 1000 == 0:
+            progress.setValue(int(100.0 * trajNum / numTrajs))
     data.changed = True
-    progress.setValue(100)
+    if not progress is None:
+        progress.setValue(100)
+
+def rotate90Deg(data, progress):
+    applyTransform(data, rotation90, progress=progress)
 
 
 def swapSubjects(data, progress):
@@ -68,11 +118,17 @@ def swapSubjects(data, progress):
             traj.name = n[:3] + '2'
         elif n[3] == '2':
             traj.name = n[:3] + '1'
-    rotate90Deg(data, progress)
-    rotate90Deg(data, progress)
+    applyTransform(data, rotation90.then(rotation90), progress=progress)
  
 
 def averageSameNameTrajectories(data, progress):
+    """Replaces trajectories sharing a name (except heads) by their frame by
+    frame average, split where none of them has samples.
+
+    Samples are added up trajectory by trajectory in a sum and a count
+    buffer spanning all frames of the name, so the averages are the same
+    as adding them one frame at a time.
+    """
     # index trajectories by name
     indTrajs = {}
     heads = [] 
@@ -90,25 +146,22 @@ def averageSameNameTrajectories(data, progress):
         # find begining and end frame
         beginFrame = min([t.beginFrame for t in trajs])
         endFrame = max([t.endFrame for t in trajs])
-        current = None
-        for i in range(beginFrame, endFrame):
-            # average points in frame
-            sx = 0.0
-            sy = 0.0
-            sz = 0.0
-            count = 0
-            for x, y, z in  [t.getFrame(i) for t in trajs if t.hasFrame(i)]:
-                sx += x
-                sy += y
-                sz += z
-                count += 1
-            if count >= 1:  # Append point average
-                if current is None:
-                    current = Traj(i, name)
-                    newTrajs.append(current)
-                current.pointData.append([sx/count, sy/count, sz/count])
-            else:           # Close current trajectory
-                current = None
+        sums = np.zeros((endFrame - beginFrame, 3))
+        counts = np.zeros(endFrame - beginFrame, np.int64)
+        for t in trajs:
+            first = t.beginFrame - beginFrame
+            sums[first:first+t.numFrames] += t.pointData
+            counts[first:first+t.numFrames] += 1
+        present = counts > 0
+        averages = sums[present] / counts[present, np.newaxis]
+        # Runs of frames with samples
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], present, [0]))))
+        taken = 0
+        for first, last in zip(edges[::2], edges[1::2]):
+            current = Traj(beginFrame + first, name)
+            current.pointData = averages[taken:taken + last - first]
+            taken += last - first
+            newTrajs.append(current)
         nameCount += 1
         if not progress is None:
             progress.setValue(int(100.0*nameCount / len(indTrajs.keys())))
@@ -118,7 +171,13 @@ def averageSameNameTrajectories(data, progress):
         progress.setValue(100)
     data.changed = True
 
-def fillGaps(data, maxGapTime, maxSampleTime, progress):
+interpolators = OrderedDict([
+    ('quadratic', 'Quadratic fit'),
+    ('cubic', 'Cubic spline'),
+    ('linear', 'Linear'),
+])
+
+def fillGaps(data, maxGapTime, maxSampleTime, progress, method='quadratic'):
     """Joins same name trajectories together by interpolating gaps between them.
 
     Arguments:
@@ -128,69 +187,183 @@ def fillGaps(data, maxGapTime, maxSampleTime, progress):
     maxSampleTime -- Consider at most this time from the end of a trajectory and at most
                      the same time from the begining of the next, for quadratic
                      interpolation at gap points.
-    """
+    progress      -- Progress dialog or None.
+    method        -- One of the names in interpolators. 'quadratic' fits a
+                     least squares parabola (a line for two points) to the
+                     samples around the gap, 'cubic' runs a cubic spline
+                     through them and 'linear' joins the samples next to it.
 
+    Each joined run of trajectories is written into a preallocated array and
+    all gaps are solved at once. As the samples before a gap may include
+    points filled for a previous gap, gaps are solved in rounds where all
+    the samples they depend on are already known, usually just one.
+    """
+    if not method in interpolators:
+        raise ProcessingException("Unknown interpolation method: " + str(method))
     maxGap = int(data.framerate * maxGapTime)
     maxSample = int(data.framerate * maxSampleTime)
+    if method == 'linear':
+        maxSample = min(maxSample, 1)
+    if maxSample < 1:
+        maxGap = 0
     # index trajectories by name
     indTrajs = {}
-    heads = [] 
     for traj in data.trajs:
-        if traj.name[:2] == 'Hd':
-            heads.append(traj)
-        else:
+        if traj.name[:2] != 'Hd' and traj.numFrames > 0:
             indTrajs.setdefault(traj.name, []).append(traj)
-    deleteList = []
-    numTrajs = len(indTrajs.keys())
     if not progress is None:
         progress.setValue(0)
-    trajNum = 0
+    # split each name in runs of trajectories to be joined
+    runs = []
     for name, trajs in indTrajs.items():
-        trajNum +=1
-        progress.setValue(int(100.0*trajNum/numTrajs))
-        # sort trajs by first frame
         trajs = sorted(trajs, key=lambda t: t.beginFrame)
-        t0 = trajs[0]
-        for t in trajs[1:]:
-            gap = t.beginFrame - t0.endFrame    # find gap length
-            if gap < 0:
-                raise ProcessingException("Same name trajectories overlap. " + \
-                    "Make sure trajectories are labeled correctly and use " + \
-                    "'Average trajectories by name' operation to correct minor overlaps")
-            elif gap == 0:
-                t0.pointData.extend(t.pointData)
-                deleteList.append(t)
-            elif gap > 0 and gap <= maxGap:
-                # Last points of first trajectory
-                fromPts = t0.pointData[-maxSample:]
-                # First points of second trajectory
-                toPts = t.pointData[:maxSample]
-                # Data for model fit
-                trainData = fromPts + toPts
-                fromLen, toLen = len(fromPts), len(toPts)
-                fromTime = range(fromLen)
-                gapTime = range(fromLen, fromLen + gap)
-                toTime = range(fromLen + gap, fromLen + gap + toLen)
-                time = list(fromTime) + list(toTime)
-                x = [point[0] for point in trainData]
-                y = [point[1] for point in trainData]
-                z = [point[2] for point in trainData]
-                order = 2
-                if len(time) <=2:
-                    order = 1
-                fitx = np.polyfit(time, x, 2)
-                fity = np.polyfit(time, y, 2)
-                fitz = np.polyfit(time, z, 2)
-                gapx = np.polyval(fitx, gapTime)
-                gapy = np.polyval(fity, gapTime)
-                gapz = np.polyval(fitz, gapTime)
-                gapPoints = [ [gapx[fr], gapy[fr], gapz[fr]]
-                               for fr in range(len(gapTime)) ]
-                t0.pointData.extend(gapPoints)
-                t0.pointData.extend(t.pointData)
-                deleteList.append(t)
-            else:
-                t0 = t
-    for t in deleteList:
-        data.trajs.remove(t)
+        begins = np.array([t.beginFrame for t in trajs])
+        ends = np.array([t.endFrame for t in trajs])
+        gaps = begins[1:] - ends[:-1]
+        if np.any(gaps < 0):
+            raise ProcessingException("Same name trajectories overlap. " + \
+                "Make sure trajectories are labeled correctly and use " + \
+                "'Average trajectories by name' operation to correct minor overlaps")
+        edges = np.concatenate(([0], np.flatnonzero(gaps > maxGap) + 1,
+                                [len(trajs)]))
+        for first, last in zip(edges[:-1], edges[1:]):
+            if last - first > 1:
+                runs.append(trajs[first:last])
+    # copy samples in a buffer shared by all runs, recording gaps
+    runOffsets = [0]
+    for run in runs:
+        runOffsets.append(runOffsets[-1] + run[-1].endFrame - run[0].beginFrame)
+    buff = np.empty((runOffsets[-1], 3), dtype=Traj.dtype)
+    gapStart, gapLen, before, after, rounds = [], [], [], [], []
+    for run, offset in zip(runs, runOffsets):
+        fillEnds, fillRounds = [], []
+        buff[offset:offset + run[0].numFrames] = run[0].pointData
+        prevEnd = run[0].endFrame
+        for t in run[1:]:
+            first = offset + t.beginFrame - run[0].beginFrame
+            buff[first:first + t.numFrames] = t.pointData
+            gap = t.beginFrame - prevEnd
+            if gap > 0:
+                fromLen = min(maxSample, first - gap - offset)
+                # rounds of previous gaps whose fill is in the samples before
+                r = 0
+                k = len(fillEnds) - 1
+                while k >= 0 and fillEnds[k] > first - gap - fromLen:
+                    r = max(r, fillRounds[k] + 1)
+                    k -= 1
+                gapStart.append(first - gap)
+                gapLen.append(gap)
+                before.append(fromLen)
+                after.append(min(maxSample, t.numFrames))
+                rounds.append(r)
+                fillEnds.append(first)
+                fillRounds.append(r)
+            prevEnd = t.endFrame
+    gapStart, gapLen = np.array(gapStart, int), np.array(gapLen, int)
+    before, after = np.array(before, int), np.array(after, int)
+    rounds = np.array(rounds, int)
+    numRounds = rounds.max() + 1 if len(rounds) else 0
+    for r in range(numRounds):
+        sel = rounds == r
+        if method == 'cubic':
+            fillIndex, fillData = splineFills(buff, gapStart[sel], gapLen[sel],
+                                              before[sel], after[sel])
+        else:
+            fillIndex, fillData = polyFills(buff, gapStart[sel], gapLen[sel],
+                                            before[sel], after[sel])
+        buff[fillIndex] = fillData
+        if not progress is None:
+            progress.setValue(int(90.0 * (r + 1) / numRounds))
+    # first trajectory of each run takes all samples
+    deleted = set()
+    for run, offset, end in zip(runs, runOffsets, runOffsets[1:]):
+        run[0].pointData = buff[offset:end]
+        deleted.update(id(t) for t in run[1:])
+    data.trajs = [t for t in data.trajs if not id(t) in deleted]
+    if not progress is None:
+        progress.setValue(100)
     data.changed = True
+
+def gapSamples(start, gap, before, after):
+    """Buffer indices and times relative to the gap start of the samples
+    around each gap, with the gap each sample belongs to."""
+    n = before + after
+    gapIndex = np.repeat(np.arange(len(n)), n)
+    pos = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    time = pos - before[gapIndex]
+    time[time >= 0] += gap[gapIndex][time >= 0]
+    return start[gapIndex] + time, time, gapIndex
+
+def gapPoints(start, gap):
+    "Buffer indices and times relative to the gap start of the gap points."
+    gapIndex = np.repeat(np.arange(len(gap)), gap)
+    time = np.arange(gap.sum()) - np.repeat(np.cumsum(gap) - gap, gap)
+    return start[gapIndex] + time, time, gapIndex
+
+def polyFills(buff, start, gap, before, after):
+    """Least squares parabolas through the samples around each gap, or lines
+    when there are only two samples, evaluated at the gap points.
+
+    Time is scaled to [-1, 1] around each gap, so the normal equations of all
+    gaps and axes can be solved in one batched call."""
+    index, time, gapIndex = gapSamples(start, gap, before, after)
+    segments = np.cumsum(before + after) - (before + after)
+    scale = (before + gap + after).astype(float)
+    powers = np.empty((len(time), 5))
+    powers[:,0] = 1.0
+    powers[:,1] = time / scale[gapIndex]
+    for p in range(2, 5):
+        powers[:,p] = powers[:,p-1] * powers[:,1]
+    sums = np.add.reduceat(powers, segments)
+    lhs = sums[:, [[0, 1, 2], [1, 2, 3], [2, 3, 4]]]
+    rhs = np.add.reduceat(powers[:,:3,np.newaxis] * buff[index][:,np.newaxis,:],
+                          segments)
+    # Lines through two points
+    linear = before + after <= 2
+    lhs[linear, 2, :] = 0.0
+    lhs[linear, :, 2] = 0.0
+    lhs[linear, 2, 2] = 1.0
+    rhs[linear, 2, :] = 0.0
+    coefs = np.linalg.solve(lhs, rhs)
+    index, time, gapIndex = gapPoints(start, gap)
+    t = (time / scale[gapIndex])[:, np.newaxis]
+    c = coefs[gapIndex]
+    return index, c[:,0] + t * (c[:,1] + t * c[:,2])
+
+def splineFills(buff, start, gap, before, after):
+    """Natural cubic splines through the samples around each gap evaluated at
+    the gap points.
+
+    The tridiagonal systems for the second derivatives of all gaps make up a
+    single banded system, solved in one call."""
+    index, time, gapIndex = gapSamples(start, gap, before, after)
+    n = len(time)
+    segments = np.cumsum(before + after) - (before + after)
+    ends = np.zeros(n, bool)
+    ends[segments] = True
+    ends[segments + before + after - 1] = True
+    y = buff[index]
+    h = np.diff(time).astype(float)
+    h[ends[:-1] & ends[1:]] = 1.0   # across gaps, rows are identities anyway
+    slopes = np.diff(y, axis=0) / h[:, np.newaxis]
+    hPrev = np.concatenate(([0.0], h))
+    hNext = np.concatenate((h, [0.0]))
+    interior = ~ends
+    bands = np.zeros((3, n))
+    bands[1] = 1.0
+    bands[1, interior] = 2.0 * (hPrev + hNext)[interior]
+    bands[0, 1:] = np.where(interior, hNext, 0.0)[:-1]
+    bands[2, :-1] = np.where(interior, hPrev, 0.0)[1:]
+    rhs = np.zeros((n, 3))
+    rhs[1:-1][interior[1:-1]] = 6.0 * (slopes[1:] - slopes[:-1])[interior[1:-1]]
+    second = solve_banded((1, 1), bands, rhs)
+    # Gap points lie between the last sample before and the first after
+    knot = (segments + before - 1)
+    index, time, gapIndex = gapPoints(start, gap)
+    k = knot[gapIndex]
+    width = (gap + 1.0)[gapIndex][:, np.newaxis]
+    left = (time + 1.0)[:, np.newaxis]
+    right = width - left
+    return index, ((second[k] * right ** 3 + second[k+1] * left ** 3) / (6.0 * width)
+                   + (y[k] / width - second[k] * width / 6.0) * right
+                   + (y[k+1] / width - second[k+1] * width / 6.0) * left)
@@ -148,22 +148,24 @@ class ModelState:
     def selNextTraj(self):
         if self.data is None:
             return
-        start = self.traj
-        self.traj = (self.traj+1) % self.data.numTrajs
-        while self.traj != start:
-            if self.currentTraj().hasFrame(self.frame):
-                break
-            self.traj = (self.traj+1) % self.data.numTrajs
+        present = self.data.frameIndex.alive(self.frame)
+        after = present[present > self.traj]
+        before = present[present < self.traj]
+        if len(after) > 0:
+            self.traj = int(after[0])
+        elif len(before) > 0:
+            self.traj = int(before[0])
 
     def selPrevTraj(self):
         if self.data is None:
             return
-        start = self.traj
-        self.traj = (self.data.numTrajs + self.traj - 1) % self.data.numTrajs
-        while self.traj != start:
-            if self.currentTraj().hasFrame(self.frame):
-                break
-            self.traj = (self.data.numTrajs+self.traj-1) % self.data.numTrajs
+        present = self.data.frameIndex.alive(self.frame)
+        after = present[present > self.traj]
+        before = present[present < self.traj]
+        if len(before) > 0:
+            self.traj = int(before[-1])
+        elif len(after) > 0:
+            self.traj = int(after[-1])
 
 
     def currentIsUnlabeled(self):
@@ -197,13 +199,12 @@ class ModelState:
     def selNextBreak(self):
         if self.data is None:
             return
-        currentTrajs = [x for x in self.data.trajs if x.hasFrame(self.frame)]
-        if len(currentTrajs) > 0:
-            byEndFrame = sorted(currentTrajs, key=lambda x: x.endFrame)
-            self.frame = byEndFrame[0].endFrame
+        first = self.data.frameIndex.nextEnd(self.frame)
+        if first is not None:
+            self.frame = self.data.trajs[first].endFrame
             if self.frame >= self.data.numFrames:
                 self.frame = max(0, self.data.numFrames-1)
-            self.traj = self.data.trajs.index(byEndFrame[0])
+            self.traj = first
 
     def deleteCurrent(self):
         if self.data is None:
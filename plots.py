@@ -5,7 +5,7 @@ from mpl_toolkits.mplot3d import Axes3D
 from pystats import fitPca, fitPcaRotation, fftCorr, fftCorrPair
 import analysis
 import numpy as np
-import scipy.signal as sig
+import filters
 
 def plotSubjectFunc(pd, func, subplot=True):
     "Makes a plot of a time function by subject"
@@ -175,7 +175,8 @@ def pcaDistance(plotDialog, title, transform=None, rotation=None):
     fr = int(trajdata.framerate)
     ksize = fr + int(1-(fr%2))
 #    distance = sig.medfilt(distance, [fr + int(1-(fr%2))])
-    distance = sig.lfilter(np.ones(ksize)/ksize, [1.0], distance)
+    distance = filters.filterSignal(distance, 'movavg', ksize / float(fr), fr,
+                                    steady=False)
     time = np.arange(distance.shape[0]) / float(trajdata.framerate)
     ax.plot(time, distance)
     ax.set_xlabel("Time")
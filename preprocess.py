@@ -14,7 +14,11 @@
 import c3dformat
 import dotsio
 
-def ppC3D(filename, progress):
+# With stream=True, the functions below read, trajectorize and write in one
+# pass over the file (see dotsio.trajDataStreamToH5), using less memory;
+# tracking then runs in a single process.
+
+def ppC3D(filename, progress, tracker='greedy', workers=1, stream=False):
     if progress.wasCanceled():
         return
     # Read C3D data
@@ -22,6 +26,10 @@ def ppC3D(filename, progress):
     c3d = c3dformat.C3d(filename)
     if progress.wasCanceled():
         return
+    if stream:
+        progress.setLabelText( "Trajectorizing while reading..." )
+        return dotsio.trajDataStreamToH5(dotsio.rawChunksFromC3D(c3d, progress),
+                                         progress, tracker)
     # Read raw data
     progress.setLabelText( "Extracting non-trajectorized data..." )
     rd = dotsio.rawDataFromC3D(c3d, progress)
@@ -34,7 +42,7 @@ def ppC3D(filename, progress):
         return
     # Initial trajectorization
     progress.setLabelText( "Initial trajectorization..." )
-    td = dotsio.trajDataFromRawData(rd, progress)
+    td = dotsio.trajDataFromRawData(rd, progress, tracker, workers)
     if progress.wasCanceled():
         return
     # Writing
@@ -42,9 +50,13 @@ def ppC3D(filename, progress):
     dotsio.trajDataSaveH5(td, progress)
     return td.filename
 
-def ppCSV(filename, progress):
+def ppCSV(filename, progress, tracker='greedy', workers=1, stream=False):
     if progress.wasCanceled():
         return
+    if stream:
+        progress.setLabelText( "Trajectorizing while reading..." )
+        return dotsio.trajDataStreamToH5(
+            dotsio.rawChunksFromCSV(filename, progress), progress, tracker)
     # Read raw data
     progress.setLabelText( "Extracting non-trajectorized data..." )
     rd = dotsio.rawDataFromCSV(filename, progress)
@@ -57,7 +69,7 @@ def ppCSV(filename, progress):
         return
     # Initial trajectorization
     progress.setLabelText( "Initial trajectorization..." )
-    td = dotsio.trajDataFromRawData(rd, progress)
+    td = dotsio.trajDataFromRawData(rd, progress, tracker, workers)
     if progress.wasCanceled():
         return
     # Writing
@@ -65,9 +77,13 @@ def ppCSV(filename, progress):
     dotsio.trajDataSaveH5(td, progress)
     return td.filename
 
-def ppCSV2(filename, progress):
+def ppCSV2(filename, progress, tracker='greedy', workers=1, stream=False):
     if progress.wasCanceled():
         return
+    if stream:
+        progress.setLabelText( "Trajectorizing while reading..." )
+        return dotsio.trajDataStreamToH5(
+            dotsio.rawChunksFromCSV2(filename, progress), progress, tracker)
     # Read raw data
     progress.setLabelText( "Extracting non-trajectorized data..." )
     rd = dotsio.rawDataFromCSV2(filename, progress)
@@ -80,7 +96,7 @@ def ppCSV2(filename, progress):
         return
     # Initial trajectorization
     progress.setLabelText( "Initial trajectorization..." )
-    td = dotsio.trajDataFromRawData(rd, progress)
+    td = dotsio.trajDataFromRawData(rd, progress, tracker, workers)
     if progress.wasCanceled():
         return
     # Writing
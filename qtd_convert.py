@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+# Copyright 2012 Esteban Hurtado
+#
+# This file is part of Cutedots.
+#
+# Cutedots is distributed under the terms of the Reciprocal Public License 1.5.
+#
+# Cutedots is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the Reciprocal Public License 1.5 for more details.
+#
+# You should have received a copy of the Reciprocal Public License along with
+# Cutedots. If not, see <http://opensource.org/licenses/rpl-1.5>.
+
+import argparse
+import dotsio
+
+parser = argparse.ArgumentParser(
+    description='Recursively rewrite cutedots files in another format version.')
+parser.add_argument('folder', help='Folder containing .qtd files')
+parser.add_argument('--format', default='dots 1', choices=['dots 0', 'dots 1'],
+                    help="'dots 1' packs all samples in one dataset")
+parser.add_argument('--compression', default='lzf', choices=['lzf', 'gzip', 'none'],
+                    help="Sample compression for 'dots 1'")
+args = parser.parse_args()
+
+compression = None if args.compression == 'none' else args.compression
+dotsio.convertFolder(args.folder, args.format, compression)
@@ -18,6 +18,7 @@ import numpy as np
 import dotsio as dio
 import os
 import transform
+import filters
 import modelops
 import pylab as pl
 import math
@@ -89,14 +90,9 @@ class SegSpeakers(Segmentation):
         self.maxInterrupt = maxInterrupt
 
     def lpFilter(self, s, framerate):
-        a = math.exp(-1/(2*framerate))
-        b = 1.0 - a
-        y_1 = s[0]
-        out = []
-        for x0 in s:
-            y_1 = a*y_1 + b*x0
-            out.append(y_1)
-        return np.array(out)
+        # Single pole with h = exp(-1/(2*framerate)), starting at s[0]
+        return filters.filterSignal(s, 'lowpass', 1.0 / (4.0 * math.pi),
+                                    framerate, 1)
 
     def postProcess(self, td, begin, end):
         e1, e2 = [e[begin:end] for e in self.energies]
@@ -5,6 +5,7 @@ import analysis as an
 import trajdata as td
 import copy
 import modelops as mops
+import filters
 from fragdata import FragmentData
 
 
@@ -30,15 +31,14 @@ def makeSegmentation(indir,outdir,min_seconds,min_seconds_speaker,window_width):
                 
 
 def movAvgFilter(trajData,window_width,subject_id):
-    window_vec = np.ones(window_width,'d')
-    window_filt = window_vec/window_vec.sum()
     if (subject_id == 2):
         subj = [t for t in trajData.trajs if t.subject == 2]
     else:
         subj = [t for t in trajData.trajs if t.subject == 1]
     e = an.energy(subj, transform=lambda x: x)
-    e_filt = np.convolve(window_filt,e,mode='valid')
-    return e_filt
+    # Causal moving average, keeping only full windows
+    e_filt = filters.filterSignal(e, 'movavg', window_width, 1)
+    return e_filt[window_width-1:]
 
 
 def findSpeaker(e1,e2,min_seconds,min_seconds_speaker,trajData,fn,directory):
@@ -134,25 +134,11 @@ def theSegmentator(zc_left,zc_right,speaker,trajData,fn,directory):
 
 
 def rotate90DegAux(data):
-    trajNum = 0
-    numTrajs = data.numTrajs
-    for traj in data.trajs:
-        for i in range(traj.numFrames):
-            x, y, z = traj.pointData[i]
-            traj.pointData[i] = -y, x, z
-        trajNum += 1
-    data.changed = True
+    mops.rotate90Deg(data, None)
     
 
 def swapSubjectsAux(data):
-    for traj in data.trajs:
-        n = traj.name
-        if n[3] == '1':
-            traj.name = n[:3] + '2'
-        elif n[3] == '2':
-            traj.name = n[:3] + '1'
-    rotate90DegAux(data)
-    rotate90DegAux(data)
+    mops.swapSubjects(data, None)
 
 def checkDirs(dirname):
     if (dirname[-1] == os.path.sep):
@@ -17,7 +17,6 @@ import sys
 import numpy as np
 import numpy.ma as ma
 import scipy as sp
-import scipy.spatial.distance as spDistance
 from sys import float_info
 import os
 import errors
@@ -34,6 +33,45 @@ def log(msg, lf=True):
 ### RAW data storage
 ####################
 
+def uniquePointMask(points, frames, maxDist=1):
+    """Boolean mask of points not closer than maxDist to an earlier point
+    of the same frame. frames holds the frame of every point; points of a
+    frame must be contiguous.
+
+    Points are sorted by frame and x, and the sorted sequence is swept
+    comparing each point with the k-th next one, k = 1, 2, ... while they
+    are in the same frame and less than maxDist apart in x. Candidate
+    pairs are then checked with the exact distance pdist would give.
+    """
+    points = np.asarray(points)
+    frames = np.asarray(frames)
+    keep = np.ones(len(points), bool)
+    if len(points) < 2:
+        return keep
+    x = points[:,0].astype(np.float64)
+    # Sort by frame, then x; ranking x first makes it one integer sort
+    rank = np.empty(len(x), np.int64)
+    rank[np.argsort(x)] = np.arange(len(x))
+    order = np.argsort((frames - frames[0]).astype(np.int64) * len(x) + rank)
+    x, frames = x[order], frames[order]
+    reach = maxDist * (1 + 1e-9)
+    first = np.arange(len(points) - 1)
+    k = 1
+    while len(first) > 0:
+        first = first[first + k < len(points)]
+        second = first + k
+        near = (frames[second] == frames[first]) & \
+               (x[second] - x[first] < reach)
+        first, second = first[near], second[near]
+        i, j = order[first], order[second]
+        diff = points[i].astype(np.float64) - points[j]
+        close = np.sqrt(np.sum(diff * diff, axis=1)) < maxDist
+        # The later point of a close pair goes
+        keep[np.maximum(i, j)[close]] = False
+        k += 1
+    return keep
+
+
 class RawFrame:
     "Non-trajectorized frame"
 
@@ -41,21 +79,25 @@ class RawFrame:
         # Copy valid data
         self.data = arr[arr[:,3] >= 0][:,:3]
 
+    @classmethod
+    def fromPoints(cls, data):
+        "Frame holding (N, 3) valid point coordinates without copying."
+        frame = cls.__new__(cls)
+        frame.data = data
+        return frame
+
     def getSinglePoint(self, index):
         return self.data[index,:]
 
+    def uniquePoints(self, maxDist=1):
+        "Boolean mask of points not closer than maxDist to a previous point"
+        return uniquePointMask(self.data, np.zeros(self.numPoints), maxDist)
+
     def joinClosePoints(self, maxDist=1):
         if self.numPoints == 0:
             return
-        # Initially all points are marked unique
-        uniquePoint = [True] * self.numPoints
-        sqDistance = spDistance.squareform(spDistance.pdist(self.data))
-        for i in range(self.numPoints):
-            for j in range(i+1, self.numPoints):
-                if sqDistance[i,j] < maxDist:
-                    uniquePoint[j] = False
         # Rebuild frame data
-        self.data = self.data[np.array(uniquePoint),:]
+        self.data = self.data[self.uniquePoints(maxDist),:]
 
     @property
     def numPoints(self):
@@ -72,43 +114,209 @@ class RawDataReadError(Exception):
         return 'Raw data read error: ' + self.msg
 
 class RawData:
-    "Array of raw frames"
+    """Array of raw frames.
+
+    Valid points of every frame are stored in one (N, 3) array, points,
+    and frame i spans points[offsets[i]:offsets[i+1]] (CSR layout).
+    Indexing returns a RawFrame viewing that range; replacing the data
+    of such a frame does not modify the RawData.
+    """
 
     @property
     def numFrames(self):
-        return len(self.frames)
+        return len(self.offsets) - 1
 
-    def __init__(self):
-        self.frames = []
+    @property
+    def totalPoints(self):
+        return self.points.shape[0]
+
+    @property
+    def pointCounts(self):
+        "Number of points in each frame"
+        return np.diff(self.offsets)
+
+    def __init__(self, points=None, offsets=None):
+        if points is None:
+            points = np.zeros((0, 3), np.float32)
+            offsets = np.zeros(1, np.int64)
+        self.points = points
+        self.offsets = np.asarray(offsets, np.int64)
         self.filename = None
         self.frameRate = 100.0
 
-    def joinClosePoints(self, progress):
-        i = 0
-        for frame in self.frames:
-            if i % 1000 == 0:
-                progress.setValue( int(100.0*i / self.numFrames) )
-                if progress.wasCanceled():
-                    return                
-            frame.joinClosePoints()
-            i += 1
-        progress.setValue(100)
+    @classmethod
+    def fromRagged(cls, points, offsets):
+        """Raw data from the valid points of all frames in one (N, 3) array
+        and numFrames+1 offsets delimiting each frame."""
+        return cls(points, offsets)
+
+    @classmethod
+    def fromCounts(cls, points, counts):
+        """Raw data from blocks of points and the number of points of each
+        frame in them. Both arguments are lists of arrays, concatenated in
+        order."""
+        if len(points) == 0:
+            return cls()
+        counts = np.concatenate([np.asarray(c, np.int64) for c in counts])
+        offsets = np.zeros(len(counts) + 1, np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(np.concatenate(points), offsets)
+
+    @classmethod
+    def fromFrames(cls, frames):
+        "Raw data from a sequence of RawFrame objects"
+        return cls.fromCounts([f.data for f in frames],
+                              [[f.numPoints for f in frames]])
+
+    @property
+    def frames(self):
+        "List of all frames, as views"
+        return list(self)
+
+    def joinClosePoints(self, progress, maxDist=1):
+        """Drop points closer than maxDist to an earlier point of their frame.
+
+        Frames are processed in blocks of about 200000 points, reporting
+        progress (which may be None) and checking for cancellation after
+        each one.
+        """
+        keep = np.ones(self.totalPoints, bool)
+        # Block boundaries at frame boundaries
+        bounds = np.searchsorted(self.offsets,
+                                 np.arange(0, self.totalPoints, 200000))
+        bounds = np.unique(np.concatenate((bounds, [self.numFrames])))
+        counts = self.pointCounts
+        if not (progress is None):
+            progress.setValue(0)
+        for i, (first, last) in enumerate(zip(bounds[:-1], bounds[1:])):
+            begin, end = self.offsets[first], self.offsets[last]
+            frames = np.repeat(np.arange(first, last), counts[first:last])
+            keep[begin:end] = uniquePointMask(self.points[begin:end],
+                                              frames, maxDist)
+            if progress is None:
+                continue
+            progress.setValue( int(100.0*(i+1) / (len(bounds) - 1)) )
+            if progress.wasCanceled():
+                return
+        # Compact points and shift offsets by the points removed before them
+        kept = np.zeros(self.totalPoints + 1, np.int64)
+        np.cumsum(keep, out=kept[1:])
+        self.points = self.points[keep]
+        self.offsets = kept[self.offsets]
+        if not (progress is None):
+            progress.setValue(100)
+
+    def __len__(self):
+        return self.numFrames
+
+    def __iter__(self):
+        for i in range(self.numFrames):
+            yield RawFrame.fromPoints(
+                self.points[self.offsets[i]:self.offsets[i+1]])
 
     def __getitem__(self, index):
-        return self.frames[index]
+        if index < 0:
+            index += self.numFrames
+        if not 0 <= index < self.numFrames:
+            raise IndexError("frame index out of range")
+        return RawFrame.fromPoints(
+            self.points[self.offsets[index]:self.offsets[index+1]])
 
 
 ### Trajectories
 ################
 
+# Prediction weights by (number of points, idx, backward)
+_predictionWeights = {}
+
+def predictionWeights(n, idx, backward=False):
+    """Weights giving, from n consecutive points, the value at idx of the
+    least squares polynomial through them (degree 1 for 4 points, 2 for
+    more). Points are at times -n..-1, or 0..n-1 if backward."""
+    key = (n, idx, backward)
+    if not key in _predictionWeights:
+        degree = 1 if n < 5 else 2
+        t = np.arange(n) if backward else np.arange(-n, 0)
+        design = np.vander(t, degree + 1).astype(float)
+        _predictionWeights[key] = np.vander([idx], degree + 1)[0].dot(
+            np.linalg.pinv(design))
+    return _predictionWeights[key]
+
+# Gap filling weights by (points before, points after, gap)
+_fillWeights = {}
+
+def fillWeights(fromLen, toLen, gap):
+    """(gap, fromLen+toLen) weights giving the samples missing in a gap of
+    gap frames from fromLen points before it and toLen points after it,
+    through a least squares polynomial (degree 2, 1 for two points)."""
+    key = (fromLen, toLen, gap)
+    if not key in _fillWeights:
+        time = np.concatenate((np.arange(fromLen),
+                               np.arange(fromLen+gap, fromLen+gap+toLen)))
+        degree = 2 if len(time) > 2 else 1
+        gapTime = np.arange(fromLen, fromLen+gap)
+        _fillWeights[key] = np.vander(gapTime, degree + 1).dot(
+            np.linalg.pinv(np.vander(time, degree + 1).astype(float)))
+    return _fillWeights[key]
+
+def predictEnds(trajs, idx=0.0, backward=False):
+    """Points trajectories are predicted to have idx frames after their
+    last sample, or at frame idx counted from their first one if backward,
+    as an (N, 3) array (nan for empty trajectories).
+
+    With one point the prediction is the point, with two or three their
+    mean; longer trajectories fit a polynomial to their last (first) ten
+    points. Fits are computed for all trajectories with the same number
+    of points at once, and cached in each trajectory until it changes.
+    """
+    result = np.full((len(trajs), 3), np.nan)
+    key = (idx, backward)
+    byLength = {}
+    for i, t in enumerate(trajs):
+        revision, cache = getattr(t, '_predictions', (None, None))
+        if revision != t.revision:
+            cache = {}
+            t._predictions = (t.revision, cache)
+        if key in cache:
+            result[i] = cache[key]
+            continue
+        n = min(t.numFrames, 10)
+        if n == 0:
+            continue
+        elif n < 4:
+            result[i] = np.mean(t.pointData, 0)
+            cache[key] = result[i].copy()
+        else:
+            byLength.setdefault(n, []).append(i)
+    for n, rows in byLength.items():
+        ends = np.array([trajs[i].pointData[:n] if backward else
+                         trajs[i].pointData[-n:] for i in rows])
+        result[rows] = np.tensordot(predictionWeights(n, idx, backward),
+                                    ends, (0, 1))
+        for i in rows:
+            trajs[i]._predictions[1][key] = result[i].copy()
+    return result
+
+
 class Traj:
-    "Same point at different frames."
+    """Same point at different frames.
+
+    Samples are kept in a single (N, 3) array. Extra capacity is reserved
+    when points are added one by one, so appending is amortized O(1).
+    Slices (split, frame ranges, cuts) are views sharing the original
+    buffer; a sliced trajectory reallocates before growing, so it never
+    writes over samples owned by another trajectory.
+
+    Every change to the samples through this class increments revision,
+    which lets cached views built from the trajectory detect stale data.
+    """
 
     nameCounter = 0
+    dtype = np.float64
 
     def __init__(self, beginFrame, name=None):
         self.name = ("tr_%d" % self.newCounter) if name is None else name
-        self.pointData = []
+        self.pointData = None
         self.beginFrame = beginFrame
 
     def newFromFrameRange(self, begin, end):
@@ -117,9 +325,37 @@ class Traj:
         return newTraj
 
     @property
-    def endFrame(self): return self.beginFrame + len(self.pointData)
+    def pointData(self):
+        "(numFrames, 3) array view of trajectory samples."
+        return self._buffer[:self._length]
+
+    @pointData.setter
+    def pointData(self, points):
+        if points is None:
+            points = np.empty((0, 3), dtype=Traj.dtype)
+        points = np.asarray(points, dtype=Traj.dtype)
+        if points.size == 0:
+            points = points.reshape((0, 3))
+        self._buffer = points
+        self._length = points.shape[0]
+        self.touch()
+
+    def touch(self):
+        "Mark samples as modified (needed after writing into pointData in place)."
+        self.revision = getattr(self, 'revision', 0) + 1
+
+    def reserve(self, capacity):
+        "Make room for at least capacity samples without reallocating."
+        if capacity <= self._buffer.shape[0]:
+            return
+        buf = np.empty((capacity, 3), dtype=Traj.dtype)
+        buf[:self._length] = self._buffer[:self._length]
+        self._buffer = buf
+
     @property
-    def numFrames(self): return len(self.pointData)
+    def endFrame(self): return self.beginFrame + self._length
+    @property
+    def numFrames(self): return self._length
     @property
     def isHead(self): return self.part == 'Hd'
 
@@ -183,13 +419,27 @@ class Traj:
         return newTraj
 
     def addPoint(self, point):
-        self.pointData.append(point)
+        if self._length == self._buffer.shape[0]:
+            self.reserve(max(16, 2 * self._length))
+        self._buffer[self._length] = point
+        self._length += 1
+        self.revision += 1
+
+    def extend(self, points):
+        "Append an array (or list) of points at the end of the trajectory."
+        points = np.asarray(points, dtype=Traj.dtype).reshape((-1, 3))
+        n = points.shape[0]
+        if self._length + n > self._buffer.shape[0]:
+            self.reserve(max(self._length + n, 2 * self._length))
+        self._buffer[self._length:self._length+n] = points
+        self._length += n
+        self.revision += 1
 
     def average(self):
         return np.mean(self.pointData,0)
 
     def averageX(self):
-        return float(np.mean([x[0] for x in self.pointData]))
+        return float(np.mean(self.pointData[:,0]))
 
     def hasFrame(self, framenum):
         """Returns True if given frame is included in trajectory's range"""
@@ -230,36 +480,16 @@ class Traj:
             return t
 
     def predict(self, idx=0.0):
-        numpts = self.numFrames
-        if numpts == 0:     # No data, no predicton
+        "Point predicted idx frames after the last one, None if empty."
+        if self.numFrames == 0:     # No data, no predicton
             return None
-        elif numpts == 1:   # One point, predict with itself
-            return self.pointData[0]
-        elif numpts in [2, 3]:  # Average
-            return np.mean(self.pointData, 0)
-        elif numpts > 3:   # Fit a polynomial
-            degree = 1 if numpts < 5 else 2
-            p = self.pointData[-10:]
-            n = len(p)
-            t = range(-n, 0)
-            fit = np.polyfit(t,p,degree)
-            return np.polyval(fit, idx)
+        return predictEnds([self], idx)[0]
 
     def backPredict(self, idx=0):
-        numpts = self.numFrames
-        if numpts == 0:     # No data, no predicton
+        "Point predicted at frame idx counted from the first one."
+        if self.numFrames == 0:     # No data, no predicton
             return None
-        elif numpts == 1:   # One point, predict with itself
-            return self.pointData[0]
-        elif numpts in [2, 3]:  # Average
-            return np.mean(self.pointData, 0)
-        elif numpts > 3:   # Fit a polynomial
-            degree = 1 if numpts < 5 else 2
-            p = self.pointData[:10]
-            n = len(p)
-            t = range(n)
-            fit = np.polyfit(t,p,degree)
-            return np.polyval(fit, idx)
+        return predictEnds([self], idx, backward=True)[0]
 
     def overlaps(self, other):
         "Returns true if there's a non empty intersection between frame ranges."
@@ -272,9 +502,241 @@ class Traj:
     def __getitem__(self, index):
         return self.pointData[index]
 
+
+class LazyTraj(Traj):
+    """Trajectory whose samples stay in a backing store until needed.
+
+    Name, begin frame and length are known without reading samples, which
+    are requested from the store on access (the store may evict them again
+    later). Once samples are modified they are pinned in memory and no
+    longer depend on the store.
+
+    The store must provide load(traj) -> array, readSlice(traj, begin, end)
+    and release(traj).
+    """
+
+    def __init__(self, store, key, beginFrame, name, numFrames, average=None):
+        self.name = name
+        self.beginFrame = beginFrame
+        self.store = store
+        self.key = key
+        self._own = None
+        self._length = numFrames
+        self._average = average
+        self.revision = 1
+
+    @property
+    def _buffer(self):
+        if self._own is not None:
+            return self._own
+        return self.store.load(self)
+
+    @_buffer.setter
+    def _buffer(self, points):
+        if self._own is None:
+            self.store.release(self)
+        self._own = points
+        self._average = None
+
+    @property
+    def pinned(self):
+        return self._own is not None
+
+    def pin(self):
+        "Keep samples in memory, independently of the store."
+        if self._own is None:
+            self._buffer = self.store.load(self)
+
+    def touch(self):
+        self.pin()
+        self._average = None
+        Traj.touch(self)
+
+    def newFromFrameRange(self, begin, end):
+        if self.pinned:
+            return Traj.newFromFrameRange(self, begin, end)
+        newTraj = Traj(0, self.name)
+        newTraj.pointData = self.store.readSlice(
+            self, begin-self.beginFrame, end-self.beginFrame)
+        return newTraj
+
+    def average(self):
+        "Stored or, the first time it is needed, computed average."
+        if self._average is None:
+            self._average = Traj.average(self)
+        return self._average
+
+    def averageX(self):
+        return float(self.average()[0])
+
+    def __deepcopy__(self, memo):
+        newTraj = Traj(self.beginFrame, self.name)
+        newTraj.pointData = self.pointData.copy()
+        return newTraj
+
+
 ### Trajectorized data
 ######################
 
+def trajsToFrameMatrix(trajs, minFrame, numFrames, position=None, valid=None):
+    """Dense samples for a list of trajectories.
+
+    Returns a (len(trajs), numFrames, 3) position array, starting at
+    minFrame and zero where there is no data, and a boolean
+    (len(trajs), numFrames) validity array. Existing arrays may be passed
+    to be filled in place.
+    """
+    if position is None:
+        position = np.zeros((len(trajs), numFrames, 3))
+    if valid is None:
+        valid = np.zeros((len(trajs), numFrames), dtype=bool)
+    for i, t in enumerate(trajs):
+        fillFrameMatrixRow(position[i], valid[i], t, minFrame)
+    return position, valid
+
+def fillFrameMatrixRow(position, valid, traj, minFrame):
+    "Write one trajectory into a row of a frame matrix."
+    numFrames = position.shape[0]
+    begin = max(0, traj.beginFrame - minFrame)
+    end = min(numFrames, traj.endFrame - minFrame)
+    position[...] = 0.0
+    valid[...] = False
+    if end > begin:
+        offset = minFrame + begin - traj.beginFrame
+        position[begin:end] = traj.pointData[offset:offset+end-begin]
+        valid[begin:end] = True
+
+
+class FrameMatrixCache:
+    """Dense (traj, frame, xyz) view of a TrajData, updated incrementally.
+
+    Rows are keyed by trajectory identity and remembered together with
+    the trajectory's revision and begin frame, so only trajectories that
+    were modified (or added) since the last call are copied again.
+    """
+
+    def __init__(self):
+        self.minFrame = 0
+        self.trajs = []
+        self.keys = []
+        self.position = np.zeros((0, 0, 3))
+        self.valid = np.zeros((0, 0), dtype=bool)
+        self.mask = None
+
+    @staticmethod
+    def key(traj):
+        return (traj.revision, traj.beginFrame, traj.numFrames)
+
+    def update(self, trajs, minFrame, numFrames):
+        sameFrames = minFrame == self.minFrame and \
+                     numFrames == self.position.shape[1]
+        if sameFrames and len(trajs) == len(self.trajs) and \
+           all(a is b for a, b in zip(trajs, self.trajs)):
+            # Same rows; refresh the modified ones in place
+            self.position.setflags(write=True)
+            self.valid.setflags(write=True)
+            for i, t in enumerate(trajs):
+                k = FrameMatrixCache.key(t)
+                if k != self.keys[i]:
+                    fillFrameMatrixRow(self.position[i], self.valid[i],
+                                       t, minFrame)
+                    self.keys[i] = k
+                    self.mask = None
+        else:
+            # Rows were added, removed or moved. Reuse unchanged rows.
+            oldRow = dict((id(t), i) for i, t in enumerate(self.trajs))
+            position = np.zeros((len(trajs), numFrames, 3))
+            valid = np.zeros((len(trajs), numFrames), dtype=bool)
+            keys = [FrameMatrixCache.key(t) for t in trajs]
+            reuse = []
+            for i, t in enumerate(trajs):
+                j = oldRow.get(id(t))
+                if sameFrames and j is not None and self.keys[j] == keys[i]:
+                    reuse.append((i, j))
+                else:
+                    fillFrameMatrixRow(position[i], valid[i], t, minFrame)
+            if len(reuse) > 0:
+                new, old = np.array(reuse).T
+                position[new] = self.position[old]
+                valid[new] = self.valid[old]
+            self.position, self.valid = position, valid
+            self.trajs, self.keys = list(trajs), keys
+            self.minFrame = minFrame
+            self.mask = None
+        self.position.setflags(write=False)
+        self.valid.setflags(write=False)
+        return self.position, self.valid
+
+    def maskedArray(self, trajs, minFrame, numFrames):
+        """Masked (traj, frame, xyz) array. Its mask is cached along with
+        the arrays and rebuilt only when some row changed."""
+        position, valid = self.update(trajs, minFrame, numFrames)
+        if self.mask is None:
+            self.mask = np.repeat(~valid[:,:,np.newaxis], 3, 2)
+            self.mask.setflags(write=False)
+        return ma.array(position, mask=self.mask, copy=False)
+
+
+class TrajIndex:
+    """Frame range index over a list of trajectories.
+
+    Frames are grouped in blocks of blockSize. Each block keeps the
+    (ascending) list positions of the trajectories that overlap it, so
+    finding the trajectories present at a frame only checks the few
+    trajectories of one block instead of all of them. Results are
+    always given as ascending positions in the original list.
+    """
+
+    blockSize = 256
+
+    def __init__(self, trajs):
+        self.source = trajs
+        self.numTrajs = len(trajs)
+        self.begin = np.array([t.beginFrame for t in trajs], dtype=int)
+        self.end = np.array([t.endFrame for t in trajs], dtype=int)
+        B = TrajIndex.blockSize
+        nonEmpty = np.nonzero(self.end > self.begin)[0]
+        firstBlock = self.begin[nonEmpty] // B
+        lastBlock = (self.end[nonEmpty] - 1) // B
+        counts = lastBlock - firstBlock + 1
+        self.firstBlock = int(firstBlock.min()) if len(nonEmpty) > 0 else 0
+        numBlocks = int(lastBlock.max()) - self.firstBlock + 1 \
+                    if len(nonEmpty) > 0 else 0
+        # One (block, traj) entry per block covered by each trajectory
+        ids = np.repeat(nonEmpty, counts)
+        starts = np.repeat(np.cumsum(counts) - counts, counts)
+        blocks = np.repeat(firstBlock, counts) + \
+                 np.arange(len(ids)) - starts - self.firstBlock
+        order = np.argsort(blocks, kind='mergesort')
+        self.blockTrajs = ids[order]
+        self.blockStart = np.searchsorted(blocks[order],
+                                          np.arange(numBlocks + 1))
+
+    def candidates(self, frame):
+        block = frame // TrajIndex.blockSize - self.firstBlock
+        if block < 0 or block >= len(self.blockStart) - 1:
+            return self.blockTrajs[:0]
+        return self.blockTrajs[self.blockStart[block]:self.blockStart[block+1]]
+
+    def alive(self, frame):
+        "List positions of trajectories having given frame."
+        c = self.candidates(frame)
+        return c[(self.begin[c] <= frame) & (self.end[c] > frame)]
+
+    def covering(self, begin, end):
+        "List positions of trajectories having all frames in [begin, end)."
+        c = self.alive(begin)
+        return c[self.end[c] >= end]
+
+    def nextEnd(self, frame):
+        """List position of the trajectory present at frame that ends
+        first, or None if there is no trajectory at frame."""
+        c = self.alive(frame)
+        if len(c) == 0:
+            return None
+        return int(c[np.argmin(self.end[c])])
+
+
 class TrajData(object):
     """Contains trajectories.
 
@@ -290,11 +752,15 @@ class TrajData(object):
         self.changed = False
         self.trash = []
         self.framePointCount = None
+        self.frameMatrixCache = FrameMatrixCache()
+        self.store = None  # Backing store of lazily loaded trajectories
+        self.formatVersion = None  # File format to keep when saving
+        self.savedState = None  # File contents, for incremental saves
 
     def newFromFrameRange(self, begin, end):
         newtd = TrajData()
-        newtd.trajs = [t.newFromFrameRange(begin, end) for t in self.trajs
-                       if t.hasFrame(begin) and t.hasFrame(end-1)]
+        newtd.trajs = [self.trajs[i].newFromFrameRange(begin, end)
+                       for i in self.frameIndex.covering(begin, end)]
         newtd.filename = self.filename
         newtd.framerate = self.framerate
         newtd.changed = True
@@ -311,15 +777,58 @@ class TrajData(object):
         newTd.changed = True
         return newTd
 
+    @property
+    def trajs(self):
+        return self._trajs
+
+    @trajs.setter
+    def trajs(self, trajs):
+        self._trajs = trajs
+        self._frameIndex = None
+
+    @property
+    def frameIndex(self):
+        """TrajIndex for current trajectories.
+
+        Rebuilt when the trajectory list is replaced or changes length, and
+        after operations of this class that change frame ranges. Code that
+        changes frame ranges of listed trajectories in place otherwise must
+        call invalidateIndex.
+        """
+        index = self._frameIndex
+        if index is None or index.source is not self._trajs or \
+           index.numTrajs != len(self._trajs):
+            index = self._frameIndex = TrajIndex(self._trajs)
+        return index
+
+    def invalidateIndex(self):
+        self._frameIndex = None
+
+    def trajsAt(self, frame):
+        "Trajectories having given frame, in list order."
+        trajs = self.trajs
+        return [trajs[i] for i in self.frameIndex.alive(frame)]
+
+    def frameMatrix(self):
+        """Returns (position, valid) dense arrays for all trajectories.
+
+        position is (numTrajs, numFrames, 3) and valid is (numTrajs,
+        numFrames), with frames counted from minFrame. Arrays are cached
+        and read only; only trajectories modified since the previous call
+        are copied again.
+        """
+        if self.numTrajs == 0:
+            return np.zeros((0, 0, 3)), np.zeros((0, 0), dtype=bool)
+        return self.frameMatrixCache.update(
+            self.trajs, self.minFrame, self.numFrames)
+
     def asMaskedArray(self):
-        minFr = self.minFrame
-        numFr = self.numFrames
-        dataList = []
-        for t in self.trajs:
-            data = ma.array(np.zeros((numFr,3)), mask=[(True,True,True)]*numFr)
-            data[t.beginFrame-minFr:t.endFrame-minFr] = ma.array(t.pointData)
-            dataList.append(data)
-        return ma.array(dataList)
+        """frameMatrix as a masked array, masking frames without samples.
+        Frames are counted from minFrame."""
+        if self.numTrajs == 0:
+            return ma.zeros((0, 0, 3))
+        return self.frameMatrixCache.maskedArray(
+            self.trajs, self.minFrame, self.numFrames)
 
     def switchSubjects(self):
         for t in self.trajs:
@@ -367,9 +876,7 @@ class TrajData(object):
         self.framePointCount = count
 
     def numPoints(self, numFrame):
-        if self.framePointCount is None or self.changed:
-            self.countPoints()
-        return self.framePointCount[numFrame]
+        return len(self.frameIndex.alive(numFrame))
 
     def rename(self):
         for i in range(len(self.trajs)):
@@ -379,17 +886,20 @@ class TrajData(object):
         if traj in self.trajs:
             self.trash.append(traj)
             self.trajs.remove(traj)
+            self.invalidateIndex()
         self.changed = True
 
     def undelete(self):
         if len(self.trash) > 0:
             self.trajs.append( self.trash.pop() )
+            self.invalidateIndex()
 
     def splitTraj(self, traj, framenum):
         if traj in self.trajs:
             t1,t2 = traj.split(framenum)
             self.trajs.remove(traj)
             self.trajs.extend([t1, t2])
+            self.invalidateIndex()
         self.changed = True
 
 
@@ -402,6 +912,7 @@ class TrajData(object):
             if t.endFrame > cutFrame:
                 newNumFrames = cutFrame - t.beginFrame
                 t.pointData = t.pointData[:newNumFrames]
+        self.invalidateIndex()
         self.changed = True
 
     def cutLeft(self, cutFrame):
@@ -417,6 +928,7 @@ class TrajData(object):
         # Make all trajectories start at cutFrame
         for t in self.trajs:
             t.beginFrame -= cutFrame
+        self.invalidateIndex()
         self.changed = True
 
     class ContinuityError(errors.Warning):
@@ -1,11 +1,33 @@
 from trajdata import *
 import scipy.spatial.distance as spd
+from scipy.spatial import cKDTree
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from collections import OrderedDict
+import heapq
+import concurrent.futures
 import numpy as np
 from PyQt5 import QtCore
 
+# Frame to frame tracking modes, with descriptions for menus. 'hungarian'
+# takes about twice as long as 'greedy' (see benchmark.py tracking).
+trackers = OrderedDict([
+    ('greedy', 'Nearest points first'),
+    ('hungarian', 'Optimal assignment'),
+    ('predictive', 'Constant velocity prediction'),
+])
+
+# A metric(a, b) scores joining trajectory a to a later trajectory b.
+# Metrics measuring the distance between a point computed from a alone
+# and one computed from b alone carry functions metric.tails(trajs) and
+# metric.heads(trajs) giving those points for many trajectories at once.
+
 def metricEuclidean(gap):
     def metric(a,b):
-        return np.sum((np.array(b.pointData[0]) - np.array(a.pointData[-1]))**2)**0.5
+        return np.sum((b.pointData[0] - a.pointData[-1])**2)**0.5
+    metric.tails = lambda trajs: np.array([a.pointData[-1] for a in trajs])
+    metric.heads = lambda trajs: np.array([b.pointData[0] for b in trajs])
     return metric
 
 def metricEuclideanPredict(gap):
@@ -13,23 +35,72 @@ def metricEuclideanPredict(gap):
         pa = np.array(a.predict( (-1.+gap)/2 ))
         pb = np.array(b.backPredict( (-1.-gap)/2 ))
         return float(np.sum((pb-pa)**2)**0.5)
+    metric.tails = lambda trajs: predictEnds(trajs, (-1.+gap)/2)
+    metric.heads = lambda trajs: predictEnds(trajs, (-1.-gap)/2, True)
     return metric
 
 
+def linkChunk(points, offsets, tracker, threshold):
+    """Tracks the frames of a chunk, given as the points and point offsets
+    of its frames, against the frame before each. Returns for the points
+    after the first frame the index of the point they continue, or -1,
+    and the frames whose matching depends on the order of live
+    trajectories, which is not known here. Runs in worker processes."""
+    tz = Trajectorizer(None, tracker=tracker)
+    tz.distanceThreshold = threshold
+    link = np.full(offsets[-1] - offsets[1], -1, np.int64)
+    tied = []
+    for fr in range(1, len(offsets) - 1):
+        prev = points[offsets[fr-1]:offsets[fr]].astype(float)
+        pres = points[offsets[fr]:offsets[fr+1]]
+        if len(prev) == 0 or len(pres) == 0:
+            continue
+        if tz.hasTies(prev, pres):
+            tied.append(fr)
+        matches = np.array(tz.matchFrame(prev, pres), np.int64).reshape(-1, 2)
+        link[offsets[fr] - offsets[1] + matches[:,1]] = \
+            offsets[fr-1] + matches[:,0]
+    return link, tied
+
+def chainRoots(link, root, begin, end):
+    """Sets root[begin:end] to the first point of the chain of links of
+    each point in that range, given root for the points before begin."""
+    r = np.where(link[begin:end] < 0, np.arange(begin, end), link[begin:end])
+    outside = r < begin
+    r[outside] = root[r[outside]]
+    while True:
+        nxt = np.where(r >= begin, r[np.maximum(r - begin, 0)], r)
+        if np.array_equal(nxt, r):
+            break
+        r = nxt
+    root[begin:end] = r
+
+
 class Trajectorizer:
 
-    def __init__(self, rdata, progress=None):
+    def __init__(self, rdata, progress=None, tracker='greedy', workers=1):
+        if not tracker in trackers:
+            raise ValueError('Unknown tracker: %s' % tracker)
         self.rdata = rdata
         self.progress = progress
         self.trajs = []
         self.distanceThreshold = 10
+        self.tracker = tracker
+        # Processes for frame to frame tracking (see parallelTraj)
+        self.workers = workers
+        # Predictive tracker: weight of each new velocity measurement,
+        # frames a lost marker is predicted for, and relative growth of
+        # the search radius per predicted frame
+        self.velocityGain = 0.6
+        self.maxCoast = 3
+        self.gateGrowth = 0.5
 
     def match(self, maxGap=3, minGap=0):
-        for i in range(minGap, maxGap+1):
-            metric = metricEuclidean(0)
-            self.matchAdjacentTrajs(metric)
-            metric = metricEuclideanPredict(0)
-            self.matchAdjacentTrajs(metric)
+        """Joins trajectories separated by minGap to maxGap missing frames,
+        negative gaps being overlaps, in a single pass."""
+        gaps = range(minGap, maxGap+1)
+        self.matchAdjacentTrajs(dict([(g, metricEuclideanPredict(g))
+                                      for g in gaps]))
 
     def trajectorize(self, maxGap=3):
         print("Trajectorization")
@@ -47,185 +118,786 @@ class Trajectorizer:
 
     @staticmethod
     def findMatches(distances, threshold):
+        """Pairs (row, column) taking the closest remaining row and column
+        while within threshold, ties going to the first in row-major order.
+        """
+        rows, cols = np.nonzero(distances <= threshold)
+        # nonzero lists candidates in row-major order; keep it among ties
+        order = np.argsort(distances[rows, cols], kind='stable')
+        usedRows, usedCols = set(), set()
         matches = []
-        for row in range(distances.shape[0]):
-            i, j = np.unravel_index(distances.argmin(), distances.shape)
-            if distances[i,j] > threshold:
-                return matches
+        for k in order:
+            i, j = rows[k], cols[k]
+            if i in usedRows or j in usedCols:
+                continue
             matches.append((i,j))
-            distances[i,:] = threshold + 1
-            distances[:,j] = threshold + 1
+            usedRows.add(i)
+            usedCols.add(j)
         return matches
 
+    @staticmethod
+    def assign(i, j, cost, limit):
+        """Optimal matching among candidate pairs (i[k], j[k]) costing
+        cost[k] <= limit: as many pairs as possible and, among those,
+        least total cost. Returns matched rows and columns."""
+        rows, i = np.unique(i, return_inverse=True)
+        cols, j = np.unique(j, return_inverse=True)
+        # Costlier than any set of allowed pairs
+        forbidden = limit * (len(cost) + 1) + 1
+        dense = np.full((len(rows), len(cols)), forbidden, float)
+        dense[i, j] = cost
+        a, b = linear_sum_assignment(dense)
+        allowed = dense[a, b] <= limit
+        return rows[a[allowed]], cols[b[allowed]]
+
+    @staticmethod
+    def findMatchesOptimal(prev, pres, threshold):
+        """Pairs (prev index, pres index) within threshold, as many as
+        possible and, among those, with least total distance.
+
+        Several assignments may be optimal; the one chosen does not depend
+        on the order of prev, which is solved sorted by coordinates (points
+        of a frame are distinct after RawData.joinClosePoints)."""
+        prev = np.asarray(prev)
+        order = np.lexsort(prev.T[::-1])
+        pairs = cKDTree(prev[order]).sparse_distance_matrix(
+            cKDTree(pres), threshold, output_type='ndarray')
+        if len(pairs) == 0:
+            return []
+        rows, cols = Trajectorizer.assign(pairs['i'], pairs['j'],
+                                          pairs['v'], threshold)
+        return list(zip(order[rows], cols))
+
+    @staticmethod
+    def findMatchesGated(pred, gate, pres):
+        """Rows of pred and points of pres matched within the radius gate
+        of each row, minimizing distances relative to the radii."""
+        none = np.zeros(0, int)
+        if len(pred) == 0 or len(pres) == 0:
+            return none, none
+        pairs = cKDTree(pred).sparse_distance_matrix(
+            cKDTree(pres), gate.max(), output_type='ndarray')
+        pairs = pairs[pairs['v'] <= gate[pairs['i']]]
+        if len(pairs) == 0:
+            return none, none
+        return Trajectorizer.assign(pairs['i'], pairs['j'],
+                                    pairs['v'] / gate[pairs['i']], 1.0)
+
+    def matchFrame(self, prev, pres):
+        "Matches between last points of current trajs and present points"
+        if self.tracker == 'hungarian':
+            return Trajectorizer.findMatchesOptimal(
+                np.asarray(prev), np.asarray(pres), self.distanceThreshold)
+        sdist = spd.cdist(prev,pres)
+        return Trajectorizer.findMatches(sdist, self.distanceThreshold)
+
+    def hasTies(self, prev, pres):
+        """Whether matchFrame may give a result depending on the order of
+        prev. The optimal assignment only does if prev repeats a point (see
+        findMatchesOptimal); nearest points first only with equal distances
+        within threshold from one row or to one column."""
+        if self.tracker == 'hungarian':
+            prev = np.asarray(prev)
+            prev = prev[np.lexsort(prev.T[::-1])]
+            return bool(np.any(np.all(prev[1:] == prev[:-1], 1)))
+        sdist = spd.cdist(prev,pres)
+        rows, cols = np.nonzero(sdist <= self.distanceThreshold)
+        v = sdist[rows, cols]
+        if len(np.unique(v)) == len(v):
+            return False
+        for side in (rows, cols):
+            keys = np.unique(np.stack((v, side)), axis=1)
+            if keys.shape[1] < len(v):
+                return True
+        return False
+
     def distanceTraj(self):
+        if self.tracker == 'predictive':
+            self.predictiveTraj()
+            return
+        if self.workers > 1 and self.rdata.numFrames > 1:
+            self.parallelTraj()
+            return
         if not (self.progress is None):
             self.progress.setValue(0)
             self.progress.setLabelText("Distance based trajectorization")
             self.progress.show()
 
-        numPoints = sum([p.numPoints for p in self.rdata.frames])
-
-        current = []
-        broken = []  # To store trajectories no longer tracked
-
-        # Add points from remaining frames
-        for fr in range(self.rdata.numFrames):
-            # If no current trajectories, make 1 trajectory for every
-            # point in present frame
-            if len(current) == 0:
-                current.extend( [Traj.newFromPoint(p,fr) for p in \
-                                 self.rdata[fr].data] )
-                continue
+        rd = self.rdata
+        pointTraj, broken, current, prev, numTrajs = self.labelFrames(
+            rd, np.zeros(0, np.int64), np.zeros((0, 3)), 0)
+        self.trajs = Trajectorizer.trajsFromLabels(
+            rd, pointTraj, numTrajs, np.concatenate(broken + [current]))
 
-            prev = [t.getFrame(fr-1) for t in current]
-            pres = [p for p in self.rdata[fr].data]
+        if not (self.progress is None):
+            self.progress.setValue(100)
 
-            if len(pres) > 0:
-                # Find distances from previous frame points to present
-                sdist = spd.cdist(prev,pres)
-                # Find matches
-                matches = Trajectorizer.findMatches(sdist, self.distanceThreshold)
+    def labelFrames(self, rd, current, prev, numTrajs):
+        """Tracks the frames of rd, continuing the live trajectories numbered
+        current, whose last points are prev, out of numTrajs so far.
+
+        Returns the trajectory number of every point of rd, the numbers of
+        trajectories broken at each frame, in order, and the live
+        trajectories, their last points and the number of trajectories
+        after the last frame.
+        """
+        # Trajectory of every raw point, numbered in order of creation
+        pointTraj = np.zeros(rd.totalPoints, np.int64)
+        broken = []  # Trajectories no longer tracked, in order
+
+        for fr in range(rd.numFrames):
+            begin = rd.offsets[fr]
+            pres = rd.points[begin:rd.offsets[fr+1]]
+
+            if len(current) > 0 and len(pres) > 0:
+                matches = np.array(self.matchFrame(prev, pres), np.int64)
+                matches = matches.reshape(-1, 2)
             else:
-                matches = []
-
-            # Append matched points and keep track of matched trajs and points
-            matchedPts = set()
-            matchedTjs = set()
-            for prevTj, presPt in matches:
-                tj, pt = current[prevTj], pres[presPt]
-                tj.addPoint(pt)
-                matchedTjs.add(tj)
-                matchedPts.add(presPt)
-            unmatchedPts = [i for i in range(len(pres)) if not (i in matchedPts)]
-            unmatchedTjs = [t for t in current if not (t in matchedTjs)]
+                matches = np.zeros((0, 2), np.int64)
+            rows, cols = matches[:,0], matches[:,1]
 
-            # Make new trajs with unmatched points
-            current.extend([Traj.newFromPoint(pres[i],fr) for i in unmatchedPts])
+            # Append matched points
+            pointTraj[begin + cols] = current[rows]
+            matchedTjs = np.zeros(len(current), bool)
+            matchedTjs[rows] = True
+            prev[rows] = pres[cols]
 
             # Remove unmatched trajs from current
-            for t in unmatchedTjs:
-                current.remove(t)
-            broken.extend(unmatchedTjs)
+            broken.append(current[~matchedTjs])
+            current, prev = current[matchedTjs], prev[matchedTjs]
+
+            # Make new trajs with unmatched points
+            unmatchedPts = np.ones(len(pres), bool)
+            unmatchedPts[cols] = False
+            newTrajs = np.arange(numTrajs, numTrajs + np.count_nonzero(unmatchedPts))
+            numTrajs += len(newTrajs)
+            pointTraj[begin + np.flatnonzero(unmatchedPts)] = newTrajs
+            current = np.concatenate((current, newTrajs))
+            prev = np.concatenate((prev, pres[unmatchedPts]))
 
             # Progress bar
             if not (self.progress is None) and (fr % 100 == 0):
-                self.progress.setValue( int(100.*fr / self.rdata.numFrames) )
+                self.progress.setValue( int(100.*fr / rd.numFrames) )
+
+        return pointTraj, broken, current, prev, numTrajs
+
+    def streamDistanceTraj(self, chunks):
+        """distanceTraj over raw data given as consecutive chunks of frames.
+
+        Yields, after each chunk, the trajectories finished in it, the
+        begin frames of live trajectories and a frame before which no live
+        or later trajectory ends or, except the live ones, begins; the live
+        trajectories come last. Trajectories come in the order of
+        distanceTraj. Only samples of live trajectories are kept.
+        """
+        current, prev, numTrajs = np.zeros(0, np.int64), np.zeros((0, 3)), 0
+        live = {}   # Begin frame and sample blocks by trajectory number
+        frame = 0
+        for rd in chunks:
+            pointTraj, broken, current, prev, numTrajs = self.labelFrames(
+                rd, current, prev, numTrajs)
+            byTraj = np.argsort(pointTraj, kind='stable')
+            labels, starts = np.unique(pointTraj[byTraj], return_index=True)
+            frameOf = frame + np.repeat(np.arange(rd.numFrames), rd.pointCounts)
+            for l, a, b in zip(labels, starts, np.append(starts[1:], len(byTraj))):
+                samples = rd.points[byTraj[a:b]]
+                if l in live:
+                    live[l][1].append(samples)
+                else:
+                    live[l] = (int(frameOf[byTraj[a]]), [samples])
+            frame += rd.numFrames
+            done = [Trajectorizer.liveTraj(live.pop(l))
+                    for l in np.concatenate(broken + [np.zeros(0, np.int64)])]
+            yield done, np.array([live[l][0] for l in current], np.int64), frame
+        yield [Trajectorizer.liveTraj(live.pop(l)) for l in current], \
+            np.zeros(0, np.int64), frame
+
+    @staticmethod
+    def liveTraj(state):
+        "Trajectory from a begin frame and a list of sample blocks"
+        t = Traj(state[0])
+        t.pointData = np.concatenate(state[1])
+        return t
+
+    def parallelTraj(self, chunkFrames=5000):
+        """Same trajectories as distanceTraj, tracked in a process pool.
+
+        Every point of a frame either continues a live trajectory or starts
+        one, and trajectories not continued are dropped, so the live
+        trajectories at a frame are exactly the points of the frame before.
+        Each chunk of frames is therefore tracked on its own, overlapping
+        the previous chunk by one frame, as links from every point to the
+        point it continues. Only the order of live trajectories, oldest
+        first, is history dependent; it matters only for frames with tied
+        distances, which are matched again here once the links before them
+        are known. Trajectories are then the chains of links.
+        """
+        if not (self.progress is None):
+            self.progress.setValue(0)
+            self.progress.setLabelText("Distance based trajectorization")
+            self.progress.show()
+
+        rd = self.rdata
+        offsets = rd.offsets
+        numChunks = max(1, min(4 * self.workers, rd.numFrames // chunkFrames))
+        bounds = np.linspace(0, rd.numFrames, numChunks + 1).astype(int)
+        # Point each point continues, or -1 if it starts a trajectory
+        link = np.full(rd.totalPoints, -1, np.int64)
+        tied = []
+        with concurrent.futures.ProcessPoolExecutor(self.workers) as pool:
+            jobs = {}
+            for begin, end in zip(bounds[:-1], bounds[1:]):
+                first = max(begin - 1, 0)
+                job = pool.submit(linkChunk,
+                                  rd.points[offsets[first]:offsets[end]],
+                                  offsets[first:end+1] - offsets[first],
+                                  self.tracker, self.distanceThreshold)
+                jobs[job] = (first, end)
+            for done, job in enumerate(concurrent.futures.as_completed(jobs)):
+                first, end = jobs[job]
+                chunkLink, chunkTied = job.result()
+                chunkLink[chunkLink >= 0] += offsets[first]
+                link[offsets[first+1]:offsets[end]] = chunkLink
+                tied.extend(first + fr for fr in chunkTied)
+                if not (self.progress is None):
+                    self.progress.setValue( int(90.*(done+1) / numChunks) )
+
+        # Rematch tied frames in order, live trajectories oldest first. A
+        # trajectory is as old as its first point.
+        root = np.zeros(rd.totalPoints, np.int64)
+        known = 0
+        for fr in sorted(tied):
+            chainRoots(link, root, offsets[known], offsets[fr])
+            known = fr
+            prevPts = np.arange(offsets[fr-1], offsets[fr])
+            prevPts = prevPts[np.argsort(root[prevPts])]
+            pres = rd.points[offsets[fr]:offsets[fr+1]]
+            matches = np.array(self.matchFrame(rd.points[prevPts].astype(float),
+                                               pres), np.int64).reshape(-1, 2)
+            link[offsets[fr]:offsets[fr+1]] = -1
+            link[offsets[fr] + matches[:,1]] = prevPts[matches[:,0]]
+        chainRoots(link, root, offsets[known], rd.totalPoints)
+
+        # Trajectories numbered in order of creation, listed as distanceTraj
+        # breaks them: by last frame, then by number
+        starts = link < 0
+        numTrajs = int(np.count_nonzero(starts))
+        pointTraj = (np.cumsum(starts) - 1)[root]
+        ends = np.ones(rd.totalPoints, bool)
+        ends[link[~starts]] = False
+        frameOf = np.repeat(np.arange(rd.numFrames), rd.pointCounts)
+        lastFrame = np.zeros(numTrajs, np.int64)
+        lastFrame[pointTraj[ends]] = frameOf[ends]
+        order = np.lexsort((np.arange(numTrajs), lastFrame))
+        self.trajs = Trajectorizer.trajsFromLabels(rd, pointTraj, numTrajs,
+                                                   order)
+
+        if not (self.progress is None):
+            self.progress.setValue(100)
 
-        self.trajs = broken + current
+    @staticmethod
+    def trajsFromLabels(rdata, pointTraj, numTrajs, order):
+        """Trajectories from the trajectory number of every raw point,
+        listed in the given order of trajectory numbers. Each holds a
+        view into one array with the samples of all of them."""
+        byTraj = np.argsort(pointTraj, kind='stable')
+        samples = rdata.points[byTraj].astype(Traj.dtype)
+        offsets = np.zeros(numTrajs + 1, np.int64)
+        np.cumsum(np.bincount(pointTraj, minlength=numTrajs), out=offsets[1:])
+        frameOf = np.repeat(np.arange(rdata.numFrames), rdata.pointCounts)
+        beginFrame = frameOf[byTraj[offsets[:-1]]] if numTrajs > 0 else []
+        trajs = []
+        for i in order:
+            t = Traj(int(beginFrame[i]))
+            t.pointData = samples[offsets[i]:offsets[i+1]]
+            trajs.append(t)
+        return trajs
+
+    def predictiveTraj(self):
+        """Frame to frame tracking matching present points against the
+        position every live trajectory is predicted to have, assuming
+        constant velocity. Velocities are smoothed as in an alpha-beta
+        filter. Trajectories missing up to maxCoast frames are kept and
+        their gap is filled linearly when the marker is found again; the
+        search radius grows with the number of predicted frames."""
+        if not (self.progress is None):
+            self.progress.setValue(0)
+            self.progress.setLabelText("Predictive trajectorization")
+            self.progress.show()
+
+        self.trajs = []
+        for done, liveBegins, frames in self.streamPredictiveTraj([self.rdata]):
+            self.trajs.extend(done)
 
         if not (self.progress is None):
             self.progress.setValue(100)
 
+    def streamPredictiveTraj(self, chunks):
+        """predictiveTraj over raw data given as consecutive chunks of
+        frames, yielding as streamDistanceTraj does."""
+        # Live trajectories and their state, row by row
+        current = []
+        pos = np.zeros((0, 3))
+        vel = np.zeros((0, 3))
+        last = np.zeros(0, int)     # Frame of last point
+        seen = np.zeros(0, int)     # Number of points
+        frame = 0
+
+        for rd in chunks:
+            broken = []
+            for i in range(rd.numFrames):
+                fr = frame + i
+                pres = rd.points[rd.offsets[i]:rd.offsets[i+1]]
+                elapsed = fr - last
+                pred = pos + vel * elapsed[:,np.newaxis]
+                gate = self.distanceThreshold * \
+                       (1 + self.gateGrowth * (elapsed - 1))
+                rows, cols = Trajectorizer.findMatchesGated(pred, gate, pres)
+
+                # Append matched points, filling predicted frames linearly
+                for r, c in zip(rows, cols):
+                    tj = current[r]
+                    if elapsed[r] > 1:
+                        step = np.arange(1, elapsed[r]) / float(elapsed[r])
+                        tj.extend(pos[r] + (pres[c] - pos[r]) * step[:,np.newaxis])
+                    tj.addPoint(pres[c])
+                measured = (pres[cols] - pos[rows]) / elapsed[rows,np.newaxis]
+                gain = np.where(seen[rows] > 1, self.velocityGain, 1.0)
+                vel[rows] += gain[:,np.newaxis] * (measured - vel[rows])
+                pos[rows] = pres[cols]
+                last[rows] = fr
+                seen[rows] += 1
+
+                # Drop trajectories predicted for too long
+                lost = fr - last > self.maxCoast
+                if np.any(lost):
+                    broken.extend([current[i] for i in np.flatnonzero(lost)])
+                    current = [current[i] for i in np.flatnonzero(~lost)]
+                    pos, vel = pos[~lost], vel[~lost]
+                    last, seen = last[~lost], seen[~lost]
+
+                # Make new trajs with unmatched points
+                unmatched = np.ones(len(pres), bool)
+                unmatched[cols] = False
+                new = np.flatnonzero(unmatched)
+                current.extend([Traj.newFromPoint(pres[i],fr) for i in new])
+                pos = np.concatenate((pos, pres[new]))
+                vel = np.concatenate((vel, np.zeros((len(new), 3))))
+                last = np.concatenate((last, np.full(len(new), fr)))
+                seen = np.concatenate((seen, np.ones(len(new), int)))
+
+                # Progress bar
+                if not (self.progress is None) and (i % 100 == 0):
+                    self.progress.setValue( int(100.*i / rd.numFrames) )
+            frame += rd.numFrames
+            # Lost trajectories may still end right after their last point
+            yield broken, np.array([t.beginFrame for t in current], np.int64), \
+                min([frame] + [l + 1 for l in last])
+        yield current, np.zeros(0, np.int64), frame
+
+    def streamTrajectorize(self, chunks, maxGap=3, minGap=0):
+        """trajectorize over raw data given as consecutive chunks of frames.
+
+        Yields lists of (position, begin frame, samples): blocks of samples
+        of the trajectories trajectorize would give, as soon as they are
+        final (see StreamMatcher). Each trajectory is identified by its
+        position in the list trajectorize would give, and its blocks come
+        in order.
+        """
+        track = self.streamPredictiveTraj if self.tracker == 'predictive' \
+                else self.streamDistanceTraj
+        matcher = StreamMatcher(self.distanceThreshold, maxGap, minGap)
+        for done, liveBegins, liveEnd in track(chunks):
+            matcher.add(done)
+            matcher.decide(np.sort(liveBegins), liveEnd)
+            yield matcher.blocks()
+        matcher.decide(np.zeros(0, np.int64), None)
+        yield matcher.blocks()
 
     def fill(self, a, b):
         gap = b.beginFrame - a.endFrame
-        fromPts = a.pointData[-10:]
-        toPts = b.pointData[:10]
-        fromLen = len(fromPts)
-        toLen = len(toPts)
-        fromTime = range(fromLen)
-        toTime = range(fromLen+gap, fromLen+gap+toLen)
-        gapTime = range(fromLen, fromLen+gap)
-        time = fromTime + toTime
-        trainData = fromPts + toPts
-        x = [p[0] for p in trainData]
-        y = [p[1] for p in trainData]
-        z = [p[2] for p in trainData]
-        order = 2
-        if len(time) <= 2:
-            order = 1
-        fitx = np.polyfit(time, x, order)
-        fity = np.polyfit(time, y, order)
-        fitz = np.polyfit(time, z, order)
-        gapx = np.polyval(fitx, gapTime)
-        gapy = np.polyval(fity, gapTime)
-        gapz = np.polyval(fitz, gapTime)
-        return [np.array([gapx[fr], gapy[fr]. gapz[fr]]) for fr in range(gap)]
+        return Trajectorizer.fillMany([(a.pointData[-10:], b.pointData[:10],
+                                        gap)])[0]
+
+    @staticmethod
+    def fillMany(junctions):
+        """Samples filling many gaps, given as (points before, points after,
+        gap) with up to ten points on each side. Gaps with the same shape
+        are interpolated together. Returns a list of (gap, 3) arrays."""
+        fills = [None] * len(junctions)
+        shapes = {}
+        for k, (fromPts, toPts, gap) in enumerate(junctions):
+            shapes.setdefault((len(fromPts), len(toPts), gap), []).append(k)
+        for (fromLen, toLen, gap), ks in shapes.items():
+            train = np.array([np.concatenate(junctions[k][:2]) for k in ks])
+            filled = np.einsum('gn,knc->kgc',
+                               fillWeights(fromLen, toLen, gap), train)
+            for k, f in zip(ks, filled):
+                fills[k] = f
+        return fills
+
+    @staticmethod
+    def chainTail(parts, end, fills, n=10):
+        """Last n samples of a chain assembled from parts[:end], which are
+        sample arrays or indices into fills. None if a fill is missing."""
+        tail = []
+        count = 0
+        for p in reversed(parts[:end]):
+            if isinstance(p, int):
+                if not p in fills:
+                    return None
+                p = fills[p]
+            tail.append(p[len(p) - min(len(p), n - count):])
+            count += len(tail[-1])
+            if count >= n:
+                break
+        if not tail:
+            return np.zeros((0, 3))
+        return np.concatenate(tail[::-1])
+
+    @staticmethod
+    def fillChains(junctions):
+        """Fills gaps in chains of trajectories, given as (parts, index,
+        points after, gap): parts holds the samples of a chain as arrays,
+        and at index the number of the junction. As in fill, the points
+        before a gap are the last ten of the chain joined so far, which may
+        include earlier fills; gaps are filled in rounds, each taking the
+        junctions whose points are known. Returns fills by junction."""
+        fills = {}
+        pending = list(range(len(junctions)))
+        while pending:
+            ready, waiting, batch = [], [], []
+            for j in pending:
+                parts, index, toPts, gap = junctions[j]
+                fromPts = Trajectorizer.chainTail(parts, index, fills)
+                if fromPts is None:
+                    waiting.append(j)
+                else:
+                    ready.append(j)
+                    batch.append((fromPts, toPts, gap))
+            fills.update(zip(ready, Trajectorizer.fillMany(batch)))
+            pending = waiting
+        return fills
 
     def matchAdjacentTrajs(self, metric, gap=0):
+        """Joins adjacent trajectories, best scoring pairs first.
+
+        metric scores pairs separated by gap frames. It may also be a dict
+        of metrics by gap, to match several gaps in one pass; among equal
+        scores, smaller gaps go first.
+
+        Candidate pairs wait in a heap ordered by score, then by position
+        in the candidate list. Joining a and b drops the other pairs
+        starting at a or ending at b, and the pairs starting at b are
+        taken over by a. Dropped pairs are only marked, and skipped when
+        popped. Joins are recorded as chains of trajectories; at the end
+        each chain is assembled into its first trajectory, all gaps filled
+        at once, and the others leave self.trajs.
+        """
+        metrics = metric if isinstance(metric, dict) else {gap: metric}
+        gaps = sorted(metrics, key=abs)
         print("Matching adjacent trajectories")
 
-        adj = self.findAdjacentTrajs(gap, metric)
+        adj = []
+        for g in gaps:
+            adj.extend([(m, a, b, g) for m, a, b in
+                        self.findAdjacentTrajs(g, metrics[g])])
         N = len(adj)
         print ("  %d pairs" % len(adj))
 
         if not (self.progress is None):
             self.progress.setValue(0)
-            self.progress.setLabelText("Matching adjacent trajectories (gap=%d)" % gap)
+            self.progress.setLabelText("Matching adjacent trajectories (gap=%s)" %
+                                       ", ".join([str(g) for g in gaps]))
             self.progress.show()
 
-        def sortKey(x):
-            try:
-                return x[0]
-            except:
-                return 1000000
-
-        while True:            
-            if len(adj) == 0:
-                break
-
-            adj.sort(key=sortKey)
-            m, a, b = adj[0]
-
+        # Trajectories as nodes, pairs as indices into adj
+        nodes = []
+        nodeOf = {}
+        first = []
+        second = []
+        outPairs = []   # Pairs currently starting at each node
+        inPairs = []    # Pairs ending at each node
+        for k, (m, a, b, g) in enumerate(adj):
+            for t in (a, b):
+                if not id(t) in nodeOf:
+                    nodeOf[id(t)] = len(nodes)
+                    nodes.append(t)
+                    outPairs.append([])
+                    inPairs.append([])
+            first.append(nodeOf[id(a)])
+            second.append(nodeOf[id(b)])
+            outPairs[first[k]].append(k)
+            inPairs[second[k]].append(k)
+        dead = [False] * N
+        heap = [(adj[k][0], k) for k in range(N)]
+        heapq.heapify(heap)
+        # Trajectories joined after each node, with the gap before each,
+        # and end frame of the whole chain
+        chains = [[] for t in nodes]
+        chainEnd = [t.endFrame for t in nodes]
+        joined = 0
+
+        while heap:
+            m, k = heapq.heappop(heap)
+            if dead[k]:
+                continue
             if m > 2*self.distanceThreshold:
                 break
+            i, j, g = first[k], second[k], adj[k][3]
 
-            # Remove pairs having a as first or b as second (idx 0 is measurement)
-            removeList = []
-            for p in adj:
-                if (p[1] == a) or (p[2] == b):
-                    removeList.append(p)
-            for p in removeList:
-                adj.remove(p)
+            # Drop pairs having a as first or b as second
+            for p in outPairs[i]:
+                dead[p] = True
+            for p in inPairs[j]:
+                dead[p] = True
 
             # Pairs having b as first now must have a as first
-            for i in range(len(adj)):
-                p = adj[i]
-                if p[1] == b:
-                    adj[i] = (p[0], a, p[2])                    
+            moved = outPairs[j] if i != j else []
+            outPairs[i], outPairs[j] = moved, []
+            for p in moved:
+                first[p] = i
 
-            # Join a and b into one trajectory
-            if a == b:
+            # Join b's chain after a's
+            if i == j:
                 print("Error. Tried to join the same traj.")
-            elif b.beginFrame - a.endFrame != gap:
+            elif nodes[j].beginFrame - chainEnd[i] != g:
                 print("Error. Tried to join trajs that are not adjacent.")
             else:
-                if gap > 0:
-                    a.pointData.extend(self.fill(a,b))
-                elif gap < 0:
-                    b.pointData = b.pointData[-gap:]
+                chains[i].append((nodes[j], g))
+                chains[i].extend(chains[j])
+                chains[j] = None
+                chainEnd[i] = chainEnd[j]
+                joined += 1
 
-                a.pointData.extend(b.pointData)
-                self.trajs.remove(b)
+            if not (self.progress is None) and (joined % 100 == 0):
+                self.progress.setValue( int(100.0*(N - len(heap))/N) )
 
-            if not (self.progress is None):
-                n = N - len(adj)
-                self.progress.setValue( int(100.0*n/N) )
+        self.joinChains(nodes, chains)
 
         if not (self.progress is None):
             self.progress.setValue(100)
 
+    def joinChains(self, nodes, chains):
+        """Puts the samples of every chain of trajectories, joined by
+        matchAdjacentTrajs, in its first one and removes the others from
+        self.trajs. Negative gaps trim the later trajectory."""
+        pieces = []
+        junctions = []  # (parts, index of the fill in parts, to, gap)
+        for node, chain in zip(nodes, chains):
+            if not chain:
+                continue
+            parts = [node.pointData]
+            for t, gap in chain:
+                data = t.pointData[-gap:] if gap < 0 else t.pointData
+                if gap > 0:
+                    junctions.append((parts, len(parts), data[:10], gap))
+                    parts.append(len(junctions) - 1)
+                parts.append(data)
+            pieces.append((node, parts))
+        fills = Trajectorizer.fillChains(junctions)
+
+        removed = set()
+        for node, parts in pieces:
+            node.pointData = np.concatenate(
+                [fills[p] if isinstance(p, int) else p for p in parts])
+        for chain in chains:
+            if chain:
+                removed.update([id(t) for t, gap in chain])
+        # Remove joined trajectories, keeping the list object
+        if removed:
+            self.trajs[:] = [t for t in self.trajs if not id(t) in removed]
+
     def findAdjacentTrajs(self, gap, metric):
+        """List of (metric(a,b), a, b) for trajectories b beginning gap
+        frames after a ends, ordered by a then b as in self.trajs. Pairs
+        scoring over 2*distanceThreshold, which are never joined, are left
+        out."""
         if not (self.progress is None):
             self.progress.setValue(0)
             self.progress.setLabelText("Finding adjacent trajectories")
             self.progress.show()
 
-        N = len(self.trajs)
-        NxN = N*N
+        trajs = self.trajs
+        N = len(trajs)
+        limit = 2*self.distanceThreshold
 
         print("Finding adjacent trajs (N=%d)" % len(self.trajs))
-        adjacent = []
-        trajs = self.trajs
-        i = 0
-        for a in trajs:
-            for b in trajs:
-                if (a != b) and ((b.beginFrame - a.endFrame) == gap):
-                    adjacent.append( (metric(a,b), a, b) )
-                i += 1
-                if not (self.progress is None) and (i % 10 == 0):
-                    self.progress.setValue( int(100.0*i/NxN) )
-        
+        # Look up trajectories by begin frame
+        begin = np.array([t.beginFrame for t in trajs], np.int64)
+        end = np.array([t.endFrame for t in trajs], np.int64)
+        byBegin = np.argsort(begin, kind='stable')
+        first = np.searchsorted(begin[byBegin], end + gap, 'left')
+        counts = np.searchsorted(begin[byBegin], end + gap, 'right') - first
+        pairOffsets = np.cumsum(counts) - counts
+        A = np.repeat(np.arange(N), counts)
+        B = byBegin[np.repeat(first - pairOffsets, counts) + np.arange(len(A))]
+        A, B = A[A != B], B[A != B]
+        if gap < 0:
+            # Overlaps must leave samples of both trajectories
+            length = end - begin
+            longer = (length[A] > -gap) & (length[B] > -gap)
+            A, B = A[longer], B[longer]
+
+        if hasattr(metric, 'tails'):
+            # Endpoints once per trajectory, then all distances at once
+            measure = np.zeros(0)
+            if len(A) > 0:
+                ends, A = np.unique(A, return_inverse=True)
+                tails = metric.tails([trajs[i] for i in ends])[A]
+                A = ends[A]
+                starts, B = np.unique(B, return_inverse=True)
+                heads = metric.heads([trajs[i] for i in starts])[B]
+                B = starts[B]
+                measure = np.sum((heads - tails)**2, axis=1)**0.5
+        else:
+            measure = np.zeros(len(A))
+            for k in range(len(A)):
+                measure[k] = metric(trajs[A[k]], trajs[B[k]])
+                if not (self.progress is None) and (k % 100 == 0):
+                    self.progress.setValue( int(100.0*k/len(A)) )
+
+        close = measure <= limit
+        adjacent = [ (m, trajs[a], trajs[b]) for m, a, b in
+                     zip(measure[close], A[close], B[close]) ]
+
         if not (self.progress is None):
             self.progress.setValue(100)
         return adjacent
+
+
+class StreamMatcher:
+    """Trajectorizer.match over trajectories arriving as tracking goes on.
+
+    match takes candidate pairs best score first, each unless its first
+    trajectory was already continued or its second one preceded. Whether
+    a pair is taken thus depends only on pairs sharing its first or its
+    second trajectory, and on the pairs those share theirs with, and so
+    on: pairs split into groups decided independently. A group is decided
+    here once no trajectory yet to come can pair with any trajectory in
+    it, giving the same joins as match on all trajectories at once.
+    Samples of joined trajectories are given out up to the last decided
+    join.
+    """
+
+    def __init__(self, threshold, maxGap=3, minGap=0):
+        self.distanceThreshold = threshold
+        self.maxGap = maxGap
+        self.minGap = minGap
+        # Gaps in the order of Trajectorizer.match
+        self.gaps = sorted(range(minGap, maxGap+1), key=abs)
+        self.numTrajs = 0
+        self.position = {}      # Of trajectories in arrival order, by id
+        self.undecided = []     # Missing successor or predecessor decision
+        self.tailDone = set()   # Ids of those with successor decided
+        self.headDone = set()   # Ids of those with predecessor decided
+        self.next = {}          # Successor and gap, by id
+        # Joined trajectories being given out: position, begin frame, last
+        # trajectory joined and its last points (None before the first)
+        self.chains = []
+
+    def add(self, trajs):
+        for t in trajs:
+            self.position[id(t)] = self.numTrajs
+            self.numTrajs += 1
+        self.undecided.extend(trajs)
+
+    def decide(self, liveBegins, liveEnd):
+        """Decides the groups of pairs no trajectory yet to come can join.
+        Those begin at one of liveBegins or at liveEnd or later, and end at
+        liveEnd or later; liveEnd is None when no more will come."""
+        trajs = self.undecided
+        n = len(trajs)
+        if n == 0:
+            return
+        begin = np.array([t.beginFrame for t in trajs], np.int64)
+        end = np.array([t.endFrame for t in trajs], np.int64)
+        if liveEnd is None:
+            openTail = openHead = np.zeros(n, bool)
+        else:
+            openTail = (end + self.maxGap >= liveEnd) | \
+                (np.searchsorted(liveBegins, end + self.minGap, 'left') <
+                 np.searchsorted(liveBegins, end + self.maxGap, 'right'))
+            openHead = begin - self.minGap >= liveEnd
+
+        # Candidate pairs, sorted as in Trajectorizer.matchAdjacentTrajs
+        sub = Trajectorizer(None)
+        sub.distanceThreshold = self.distanceThreshold
+        sub.trajs = trajs
+        index = dict((id(t), i) for i, t in enumerate(trajs))
+        pairs = []
+        for rank, g in enumerate(self.gaps):
+            for m, a, b in sub.findAdjacentTrajs(g, metricEuclideanPredict(g)):
+                if not (id(a) in self.tailDone or id(b) in self.headDone):
+                    pairs.append((m, rank, index[id(a)], index[id(b)]))
+        pairs.sort()
+
+        # Groups: tails of trajectories are nodes 0..n-1, heads n..2n-1
+        edges = np.array([(i, n + j) for m, r, i, j in pairs], np.int64)
+        edges = edges.reshape(-1, 2)
+        graph = coo_matrix((np.ones(len(edges)), (edges[:,0], edges[:,1])),
+                           shape=(2*n, 2*n))
+        numGroups, group = connected_components(graph, directed=False)
+        closed = np.ones(numGroups, bool)
+        closed[group[:n][openTail]] = False
+        closed[group[n:][openHead]] = False
+
+        continued, preceded = set(), set()
+        for m, rank, i, j in pairs:
+            if closed[group[i]] and not (i in continued or j in preceded):
+                self.next[id(trajs[i])] = (trajs[j], self.gaps[rank])
+                continued.add(i)
+                preceded.add(j)
+        for i, t in enumerate(trajs):
+            if closed[group[i]]:
+                self.tailDone.add(id(t))
+            if closed[group[n+i]] and not id(t) in self.headDone:
+                self.headDone.add(id(t))
+                if not i in preceded:
+                    self.chains.append([self.position[id(t)], t.beginFrame,
+                                        t, None])
+        self.undecided = [t for t in trajs if not
+                          (id(t) in self.tailDone and id(t) in self.headDone)]
+
+    def blocks(self):
+        """Samples of joined trajectories up to their last decided join, as
+        Trajectorizer.joinChains would give them: (position, begin frame,
+        samples) for each trajectory, in order. Only the last points of
+        trajectories still being joined are kept."""
+        parts = []
+        junctions = []
+        pending = []
+        for chain in self.chains:
+            position, beginFrame, last, tail = chain
+            if tail is None:
+                # First trajectory of the chain
+                tail = last.pointData
+                parts.append((position, beginFrame, tail))
+            samples = [tail]
+            while id(last) in self.next:
+                t, gap = self.next.pop(id(last))
+                self.forget(last)
+                data = t.pointData[-gap:] if gap < 0 else t.pointData
+                if gap > 0:
+                    junctions.append((samples, len(samples), data[:10], gap))
+                    samples.append(len(junctions) - 1)
+                    parts.append((position, beginFrame, len(junctions) - 1))
+                parts.append((position, beginFrame, data))
+                samples.append(data)
+                last = t
+            if id(last) in self.tailDone:
+                self.forget(last)
+            else:
+                pending.append(([position, beginFrame, last], samples))
+        fills = Trajectorizer.fillChains(junctions)
+        self.chains = [chain + [Trajectorizer.chainTail(samples, len(samples),
+                                                        fills)]
+                       for chain, samples in pending]
+        return [(p, b, fills[d] if isinstance(d, int) else d)
+                for p, b, d in parts]
+
+    def forget(self, t):
+        "Drops the state of a trajectory whose samples were given out"
+        del self.position[id(t)]
+        self.tailDone.discard(id(t))
+        self.headDone.discard(id(t))
@@ -12,32 +12,68 @@
 # Cutedots. If not, see <http://http://opensource.org/licenses/rpl-1.5>.
 
 import numpy as np
-import scipy.signal as sig
+import filters
 
 def filter(signal, Fc):
-    h = np.exp(-2.0 * np.pi * Fc)
-    a0 = 1.0 - h
-    b1 = h
-    y = [signal[0]]
-    for x in signal:
-        y.append( a0*x + b1*y[-1] )
-    return y[1:]
-
-def LpFilterComponent(data, Fc):
-    s = data[:]
-    for i in range(4):
-        s = filter(s, Fc)
+    """Single pole recursive low pass filter, y[n] = (1-h) x[n] + h y[n-1]
+    with h = exp(-2 pi Fc), starting as if the input had always been
+    signal[0]. Filters along the first axis, so several channels can be
+    given as columns."""
+    return filters.filterSignal(signal, 'lowpass', Fc, 1.0, 1)
+
+def lowPassSos(Fc, stages=4):
+    "Second order sections of a cascade of single pole filters."
+    return filters.design('lowpass', Fc, 1.0, stages).sos
+
+def cascade(signal, Fc, stages=4):
+    """Runs filter() stages times as a single higher order SOS filter. Every
+    stage starts from the first sample, as all of them see it first."""
+    return filters.filterSignal(signal, 'lowpass', Fc, 1.0, stages)
+
+def LpFilterComponent(data, Fc, zeroPhase=False):
+    """Four stage low pass filter along the first axis. With zeroPhase the
+    cascade is run forward and then backward, doubling the order."""
+    s = cascade(data, Fc)
+    if zeroPhase:
+        s = cascade(s[::-1], Fc)[::-1]
     return s
 
-def LpFilterTraj(traj, Fc):
-    data = np.array(traj.pointData)
-    for i in range(3):
-        data[:,i] = LpFilterComponent(data[:,i], Fc)
-    traj.pointData = [np.array(x) for x in data.tolist()]
+def LpFilterTraj(traj, Fc, zeroPhase=False):
+    if traj.numFrames > 0:
+        traj.pointData = LpFilterComponent(traj.pointData, Fc, zeroPhase)
 
+def stackTrajs(trajs, length, reverse=False):
+    """(length, len(trajs), 3) array with samples of each trajectory from the
+    start, optionally reversed, repeating its last one as padding."""
+    data = np.empty((length, len(trajs), 3))
+    for i, traj in enumerate(trajs):
+        points = traj.pointData[::-1] if reverse else traj.pointData
+        data[:traj.numFrames, i] = points
+        data[traj.numFrames:, i] = points[-1]
+    return data
 
-def LpFilterTrajData(trajdata, freq):
+def LpFilterTrajData(trajdata, freq, zeroPhase=False):
+    """Low pass filters all trajectories. Trajectories are stacked into
+    batches of similar lengths, padded at the end, and every batch is
+    filtered in one call."""
     Fc = float(freq) / float(trajdata.framerate)
-    for traj in trajdata.trajs:
-        LpFilterTraj(traj, Fc)
+    trajs = sorted([t for t in trajdata.trajs if t.numFrames > 0],
+                   key=lambda t: -t.numFrames)
+    first = 0
+    while first < len(trajs):
+        length = trajs[first].numFrames
+        last = first + 1
+        while last < len(trajs) and 2 * trajs[last].numFrames >= length \
+                and (last - first + 1) * length <= 1000000:
+            last += 1
+        batch = trajs[first:last]
+        # Each trajectory gets its own copy, so no view keeps the batch alive
+        data = cascade(stackTrajs(batch, length), Fc)
+        for i, traj in enumerate(batch):
+            traj.pointData = data[:traj.numFrames, i].copy()
+        if zeroPhase:
+            data = cascade(stackTrajs(batch, length, True), Fc)
+            for i, traj in enumerate(batch):
+                traj.pointData = data[traj.numFrames-1::-1, i].copy()
+        first = last
     trajdata.changed = True